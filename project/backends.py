@@ -0,0 +1,253 @@
+from typing import Any, Iterable, Optional, Protocol
+
+import numpy as np
+import scipy.sparse as sp
+
+from project.bitmatrix import BitMatrix
+
+
+class BooleanMatrixBackend(Protocol):
+    # boolean semiring operations the matrix algorithms are written against;
+    # the right operand of mul may also be a scipy matrix, so sparse graph
+    # matrices do not have to be converted
+    name: str
+
+    def from_coo(
+        self, rows: Iterable[int], cols: Iterable[int], shape: tuple[int, int]
+    ) -> Any: ...
+
+    def from_scipy(self, matrix: sp.spmatrix) -> Any: ...
+
+    def to_scipy(self, matrix) -> sp.csr_matrix: ...
+
+    def zeros(self, shape: tuple[int, int]) -> Any: ...
+
+    def identity(self, n: int) -> Any: ...
+
+    def mul(self, a, b) -> Any: ...
+
+    def add(self, a, b) -> Any: ...
+
+    def kron(self, a, b) -> Any: ...
+
+    def diff(self, a, b) -> Any: ...
+
+    def nnz(self, a) -> int: ...
+
+    def row_nnz(self, a) -> np.ndarray: ...
+
+    def nonzero(self, a) -> tuple[np.ndarray, np.ndarray]: ...
+
+    def transpose(self, a) -> Any: ...
+
+    def rows(self, a, rows: np.ndarray) -> Any: ...
+
+    def move_rows(
+        self, a, sources: np.ndarray, targets: np.ndarray, rows_number: int
+    ) -> Any: ...
+
+
+class ScipyBackend:
+    name = "scipy"
+
+    def from_coo(self, rows, cols, shape):
+        rows = np.asarray(rows, dtype=np.int64)
+        return sp.csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, np.asarray(cols, dtype=np.int64))),
+            shape=shape,
+            dtype=bool,
+        )
+
+    def from_scipy(self, matrix):
+        return sp.csr_matrix(matrix, dtype=bool)
+
+    def to_scipy(self, matrix):
+        return matrix
+
+    def zeros(self, shape):
+        return sp.csr_matrix(shape, dtype=bool)
+
+    def identity(self, n):
+        return sp.identity(n, dtype=bool, format="csr")
+
+    def mul(self, a, b):
+        # CSR @ CSR is CSR already, wrapping it again costs a format check
+        product = a @ b
+        return product if isinstance(product, sp.csr_matrix) else sp.csr_matrix(product)
+
+    def add(self, a, b):
+        return a + b
+
+    def kron(self, a, b):
+        return sp.kron(a, b, format="csr")
+
+    def diff(self, a, b):
+        return a > b
+
+    def nnz(self, a):
+        return a.count_nonzero()
+
+    def row_nnz(self, a):
+        return a.getnnz(axis=1)
+
+    def nonzero(self, a):
+        return a.nonzero()
+
+    def transpose(self, a):
+        return sp.csr_matrix(a.T)
+
+    def rows(self, a, rows):
+        return a[rows]
+
+    def move_rows(self, a, sources, targets, rows_number):
+        # selection matrix with a one at (target, source)
+        return self.mul(self.from_coo(targets, sources, (rows_number, a.shape[0])), a)
+
+
+class DenseBackend:
+    name = "dense"
+
+    def from_coo(self, rows, cols, shape):
+        matrix = np.zeros(shape, dtype=bool)
+        matrix[np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)] = (
+            True
+        )
+        return matrix
+
+    def from_scipy(self, matrix):
+        return sp.csr_matrix(matrix, dtype=bool).toarray()
+
+    def to_scipy(self, matrix):
+        return sp.csr_matrix(matrix, dtype=bool)
+
+    def zeros(self, shape):
+        return np.zeros(shape, dtype=bool)
+
+    def identity(self, n):
+        return np.eye(n, dtype=bool)
+
+    def mul(self, a, b):
+        if sp.issparse(b):
+            return np.asarray(b.T @ a.T).T
+        # float products go through BLAS
+        return (a.astype(np.float32) @ b.astype(np.float32)) > 0
+
+    def add(self, a, b):
+        return a | b
+
+    def kron(self, a, b):
+        return np.kron(a, b).astype(bool)
+
+    def diff(self, a, b):
+        return a & ~b
+
+    def nnz(self, a):
+        return int(np.count_nonzero(a))
+
+    def row_nnz(self, a):
+        return np.count_nonzero(a, axis=1)
+
+    def nonzero(self, a):
+        return np.nonzero(a)
+
+    def transpose(self, a):
+        return np.ascontiguousarray(a.T)
+
+    def rows(self, a, rows):
+        return a[rows]
+
+    def move_rows(self, a, sources, targets, rows_number):
+        moved = np.zeros((rows_number, a.shape[1]), dtype=bool)
+        np.logical_or.at(moved, targets, a[sources])
+        return moved
+
+
+class BitsetBackend:
+    name = "bitset"
+
+    def from_coo(self, rows, cols, shape):
+        matrix = BitMatrix(shape)
+        matrix.set(rows, cols)
+        return matrix
+
+    def from_scipy(self, matrix):
+        return BitMatrix(matrix)
+
+    def to_scipy(self, matrix):
+        return matrix.tocsr()
+
+    def zeros(self, shape):
+        return BitMatrix(shape)
+
+    def identity(self, n):
+        return self.from_coo(np.arange(n), np.arange(n), (n, n))
+
+    def mul(self, a, b):
+        return a @ b
+
+    def add(self, a, b):
+        return a + b
+
+    def kron(self, a, b):
+        return BitMatrix(sp.kron(a.tocsr(), b.tocsr(), format="csr"))
+
+    def diff(self, a, b):
+        return a > b
+
+    def nnz(self, a):
+        return a.nnz
+
+    def row_nnz(self, a):
+        return a.getnnz(axis=1)
+
+    def nonzero(self, a):
+        return a.nonzero()
+
+    def transpose(self, a):
+        return a.T
+
+    def rows(self, a, rows):
+        return a[rows]
+
+    def move_rows(self, a, sources, targets, rows_number):
+        words = np.zeros((rows_number, a.words.shape[1]), dtype=np.uint64)
+        np.bitwise_or.at(words, targets, a.words[sources])
+        return BitMatrix.from_words(words, a.shape[1])
+
+
+BACKENDS: dict[str, BooleanMatrixBackend] = {
+    backend.name: backend
+    for backend in (ScipyBackend(), DenseBackend(), BitsetBackend())
+}
+
+
+def get_backend(backend: str | BooleanMatrixBackend) -> BooleanMatrixBackend:
+    if not isinstance(backend, str):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown matrix backend {backend!r}, expected one of {sorted(BACKENDS)}"
+        )
+    return BACKENDS[backend]
+
+
+def backend_for_matrix_type(
+    matrix_type, backend: Optional[str | BooleanMatrixBackend] = None
+) -> BooleanMatrixBackend:
+    # an explicit backend wins, otherwise matrix_type picks the backend
+    # with the same matrices
+    if backend is not None:
+        return get_backend(backend)
+    if matrix_type is BitMatrix:
+        return BACKENDS["bitset"]
+    return BACKENDS["scipy"]
+
+
+def backend_transitive_closure(backend: BooleanMatrixBackend, matrix):
+    # (I + A)^(2^k) until the number of reachable pairs stops growing
+    closure = backend.add(matrix, backend.identity(matrix.shape[0]))
+    while True:
+        nnz = backend.nnz(closure)
+        closure = backend.mul(closure, closure)
+        if backend.nnz(closure) == nnz:
+            return closure
@@ -0,0 +1,190 @@
+import numpy as np
+import scipy.sparse as sp
+
+_WORD_BITS = 64
+_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+class BitMatrix:
+    # boolean matrix with every row packed into uint64 words, bit j of the
+    # row being bit j % 64 of word j // 64; accepts the same constructor
+    # arguments as the scipy classes so it can be passed as matrix_type
+    _words: np.ndarray
+    _shape: tuple[int, int]
+
+    def __init__(self, arg, shape: tuple[int, int] = None, dtype=bool):
+        if isinstance(arg, BitMatrix):
+            self._shape = arg.shape
+            self._words = arg.words.copy()
+        elif isinstance(arg, tuple):
+            self._shape = (int(arg[0]), int(arg[1]))
+            self._words = np.zeros(
+                (self._shape[0], _words_number(self._shape[1])), dtype=np.uint64
+            )
+        elif sp.issparse(arg):
+            coo = sp.coo_matrix(arg)
+            keep = coo.data != 0
+            self.__init__(coo.shape)
+            self.set(coo.row[keep], coo.col[keep])
+        else:
+            dense = np.asarray(arg, dtype=bool)
+            self._shape = dense.shape
+            self._words = _pack(dense)
+
+    @classmethod
+    def from_words(cls, words: np.ndarray, cols: int):
+        matrix = cls((words.shape[0], cols))
+        matrix._words = words
+        return matrix
+
+    @property
+    def words(self) -> np.ndarray:
+        return self._words
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self._shape
+
+    @property
+    def dtype(self):
+        return np.dtype(bool)
+
+    @property
+    def nnz(self) -> int:
+        return int(_POPCOUNT[self._words.view(np.uint8)].sum())
+
+    def count_nonzero(self) -> int:
+        return self.nnz
+
+    def getnnz(self, axis: int = None):
+        if axis is None:
+            return self.nnz
+        if axis != 1:
+            return self.tocsr().getnnz(axis=axis)
+        counts = _POPCOUNT[self._words.view(np.uint8)]
+        return counts.sum(axis=1, dtype=np.int64)
+
+    def set(self, rows: np.ndarray, cols: np.ndarray):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        bits = np.left_shift(np.uint64(1), (cols % _WORD_BITS).astype(np.uint64))
+        np.bitwise_or.at(self._words, (rows, cols // _WORD_BITS), bits)
+
+    def toarray(self) -> np.ndarray:
+        return np.unpackbits(
+            self._words.view(np.uint8), axis=1, count=self._shape[1], bitorder="little"
+        ).astype(bool)
+
+    def nonzero(self) -> tuple[np.ndarray, np.ndarray]:
+        # only the nonzero words are unpacked, in row-major order
+        rows, words = np.nonzero(self._words)
+        bits = np.unpackbits(
+            self._words[rows, words].view(np.uint8).reshape(-1, 8),
+            axis=1,
+            bitorder="little",
+        )
+        owners, offsets = np.nonzero(bits)
+        return rows[owners], words[owners] * _WORD_BITS + offsets
+
+    def tocoo(self) -> sp.coo_matrix:
+        rows, cols = self.nonzero()
+        return sp.coo_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=self._shape
+        )
+
+    def tocsr(self) -> sp.csr_matrix:
+        # nonzero is row-major already, so indptr is a count per row
+        rows, cols = self.nonzero()
+        indptr = np.zeros(self._shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=self._shape[0]), out=indptr[1:])
+        return sp.csr_matrix(
+            (np.ones(len(cols), dtype=bool), cols, indptr), shape=self._shape
+        )
+
+    def copy(self):
+        return BitMatrix(self)
+
+    def transpose(self):
+        rows, cols = self.nonzero()
+        matrix = BitMatrix((self._shape[1], self._shape[0]))
+        matrix.set(cols, rows)
+        return matrix
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def __getitem__(self, rows):
+        return BitMatrix.from_words(self._words[rows], self._shape[1])
+
+    def __or__(self, other):
+        return BitMatrix.from_words(self._words | _as_bits(other).words, self._shape[1])
+
+    __add__ = __or__
+    __radd__ = __or__
+
+    def __iadd__(self, other):
+        self._words |= _as_bits(other).words
+        return self
+
+    def __and__(self, other):
+        return BitMatrix.from_words(self._words & _as_bits(other).words, self._shape[1])
+
+    def __gt__(self, other):
+        return BitMatrix.from_words(
+            self._words & ~_as_bits(other).words, self._shape[1]
+        )
+
+    def __matmul__(self, other):
+        # row i of the product is the OR of the rows of other selected by
+        # the bits of row i; sparse operands are not packed, as a sparse
+        # graph matrix would take far more memory as bits, and their rows
+        # are gathered straight from CSR
+        rows, cols = self.nonzero()
+        if isinstance(other, BitMatrix):
+            return _or_rows(rows, other.words[cols], self._shape[0], other.shape[1])
+        other = sp.csr_matrix(other, dtype=bool)
+        begins = other.indptr[cols]
+        counts = other.indptr[cols + 1] - begins
+        owners = np.repeat(rows, counts)
+        firsts = np.cumsum(counts) - counts
+        offsets = np.arange(counts.sum()) - np.repeat(firsts, counts)
+        product = BitMatrix((self._shape[0], other.shape[1]))
+        positions = np.repeat(begins, counts) + offsets
+        keep = other.data[positions] != 0
+        product.set(owners[keep], other.indices[positions[keep]])
+        return product
+
+    def __rmatmul__(self, other):
+        coo = sp.coo_matrix(other)
+        keep = coo.data != 0
+        return _or_rows(
+            coo.row[keep], self._words[coo.col[keep]], coo.shape[0], self._shape[1]
+        )
+
+
+def _words_number(cols: int) -> int:
+    return -(-cols // _WORD_BITS)
+
+
+def _pack(dense: np.ndarray) -> np.ndarray:
+    rows, cols = dense.shape
+    packed = np.zeros((rows, _words_number(cols) * 8), dtype=np.uint8)
+    packed[:, : -(-cols // 8)] = np.packbits(dense, axis=1, bitorder="little")
+    return packed.view(np.uint64)
+
+
+def _as_bits(matrix) -> BitMatrix:
+    return matrix if isinstance(matrix, BitMatrix) else BitMatrix(matrix)
+
+
+def _or_rows(rows: np.ndarray, words: np.ndarray, rows_number: int, cols: int):
+    result = np.zeros((rows_number, _words_number(cols)), dtype=np.uint64)
+    np.bitwise_or.at(result, rows, words)
+    return BitMatrix.from_words(result, cols)
+
+
+def to_csr(matrix) -> sp.csr_matrix:
+    if isinstance(matrix, BitMatrix):
+        return matrix.tocsr()
+    return sp.csr_matrix(matrix, dtype=bool)
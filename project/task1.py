@@ -1,21 +1,304 @@
+import json
+import os
+import pathlib
+import shutil
+import tempfile
 import cfpq_data as cd
 import networkx as nx
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 
-from typing import Tuple
+from dataclasses import dataclass
+from typing import Any, Iterable, Optional, Tuple
+
+GRAPH_STORE_DIR = pathlib.Path(
+    os.getenv(
+        "GRAPH_STORE_DIR",
+        pathlib.Path.home() / ".cache" / "formal-lang-course" / "graphs",
+    )
+)
+
+_ARRAY_NAMES = ("nodes", "src", "dst", "label_ids")
+_LABELS_FILE = "labels.json"
+# bump when the stored layout changes so that stale files on disk are not used
+_GRAPH_STORE_FORMAT_VERSION = 1
+
+
+@dataclass(frozen=True)
+class GraphArrays:
+    # src and dst hold indices into nodes, label_ids hold indices into labels
+    nodes: np.ndarray
+    src: np.ndarray
+    dst: np.ndarray
+    label_ids: np.ndarray
+    labels: list
+
+    @property
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def number_of_edges(self) -> int:
+        return len(self.src)
+
+    def edges(self) -> Iterable[tuple[Any, Any, Any]]:
+        nodes = self.nodes.tolist()
+        for u, v, label_id in zip(
+            self.src.tolist(), self.dst.tolist(), self.label_ids.tolist()
+        ):
+            yield nodes[u], nodes[v], self.labels[label_id]
+
+    def sorted_labels(self) -> list:
+        counts = np.bincount(self.label_ids, minlength=len(self.labels))
+        return [
+            label
+            for label, _ in sorted(
+                zip(self.labels, counts.tolist()), key=lambda x: (-x[1], x[0])
+            )
+        ]
+
+    def to_networkx(self) -> nx.MultiDiGraph:
+        graph = nx.MultiDiGraph()
+        graph.add_nodes_from(self.nodes.tolist())
+        graph.add_edges_from((u, v, {"label": label}) for u, v, label in self.edges())
+        return graph
+
+    @classmethod
+    def from_edges(cls, src: Iterable, dst: Iterable, labels: Iterable):
+        src, dst = _values_array(src), _values_array(dst)
+        # nodes are numbered in order of first appearance, as networkx does
+        node_ids, nodes = pd.factorize(
+            np.column_stack([src, dst]).ravel(), use_na_sentinel=False
+        )
+        label_ids, label_values = pd.factorize(
+            _object_array(labels), use_na_sentinel=False
+        )
+        return cls(
+            nodes=nodes,
+            src=node_ids[0::2].astype(_index_dtype(len(nodes))),
+            dst=node_ids[1::2].astype(_index_dtype(len(nodes))),
+            label_ids=label_ids.astype(_index_dtype(len(label_values))),
+            labels=[_to_python_value(label) for label in label_values],
+        )
+
+    @classmethod
+    def from_networkx(cls, graph: nx.MultiDiGraph):
+        # nodes are hashed as they are, tuples or values of mixed types
+        # included, and keep the order of graph.nodes
+        node_to_index = {node: index for index, node in enumerate(graph.nodes)}
+        index_dtype = _index_dtype(len(node_to_index))
+        edges_number = graph.number_of_edges()
+        edges = graph.edges(data="label")
+        label_ids, label_values = pd.factorize(
+            _object_array(label for _, _, label in edges), use_na_sentinel=False
+        )
+        return cls(
+            nodes=_object_array(graph.nodes),
+            src=np.fromiter(
+                (node_to_index[u] for u, _, _ in edges), index_dtype, edges_number
+            ),
+            dst=np.fromiter(
+                (node_to_index[v] for _, v, _ in edges), index_dtype, edges_number
+            ),
+            label_ids=label_ids.astype(_index_dtype(len(label_values))),
+            labels=[_to_python_value(label) for label in label_values],
+        )
+
+
+class LabeledGraph:
+    _nodes: list
+    _node_to_index: dict[Any, int]
+    _matrices: dict[Any, sp.csr_matrix]
+    _transposed_matrices: Optional[dict[Any, sp.csr_matrix]]
+
+    def __init__(self, nodes: list, matrices: dict[Any, sp.csr_matrix]):
+        self._nodes = nodes
+        self._node_to_index = {node: idx for idx, node in enumerate(nodes)}
+        self._matrices = matrices
+        self._transposed_matrices = None
+
+    @classmethod
+    def from_arrays(cls, arrays: GraphArrays):
+        nodes_number = arrays.number_of_nodes
+        label_ids = np.asarray(arrays.label_ids)
+        # group edges by label once, every label then takes a contiguous slice
+        order = np.argsort(label_ids, kind="stable")
+        bounds = np.searchsorted(label_ids[order], np.arange(len(arrays.labels) + 1))
+        src = np.asarray(arrays.src)[order]
+        dst = np.asarray(arrays.dst)[order]
+
+        matrices = {}
+        for label_id, label in enumerate(arrays.labels):
+            begin, end = bounds[label_id], bounds[label_id + 1]
+            matrices[label] = sp.csr_matrix(
+                (np.ones(end - begin, dtype=bool), (src[begin:end], dst[begin:end])),
+                shape=(nodes_number, nodes_number),
+            )
+        return cls(arrays.nodes.tolist(), matrices)
+
+    @classmethod
+    def from_edges(cls, src: Iterable, dst: Iterable, labels: Iterable):
+        return cls.from_arrays(GraphArrays.from_edges(src, dst, labels))
+
+    @classmethod
+    def from_networkx(cls, graph: nx.MultiDiGraph):
+        return cls.from_arrays(GraphArrays.from_networkx(graph))
+
+    @property
+    def nodes(self) -> list:
+        return self._nodes
+
+    @property
+    def node_to_index(self) -> dict[Any, int]:
+        return self._node_to_index
+
+    @property
+    def matrices(self) -> dict[Any, sp.csr_matrix]:
+        return self._matrices
+
+    @property
+    def transposed_matrices(self) -> dict[Any, sp.csr_matrix]:
+        # CSR matrices of the reversed edges, built on first use and kept
+        # for every later query on the graph
+        if self._transposed_matrices is None:
+            self._transposed_matrices = {
+                label: sp.csr_matrix(matrix.T)
+                for label, matrix in self._matrices.items()
+            }
+        return self._transposed_matrices
+
+    @property
+    def labels(self) -> list:
+        return list(self._matrices.keys())
+
+    @property
+    def number_of_nodes(self) -> int:
+        return len(self._nodes)
+
+    @property
+    def number_of_edges(self) -> int:
+        return sum(matrix.nnz for matrix in self._matrices.values())
+
+    def indices(self, nodes: Iterable) -> np.ndarray:
+        # nodes missing from the graph are skipped
+        return np.fromiter(
+            (
+                self._node_to_index[node]
+                for node in nodes
+                if node in self._node_to_index
+            ),
+            dtype=np.int64,
+        )
+
+    def edges(self) -> Iterable[tuple[Any, Any, Any]]:
+        for label, matrix in self._matrices.items():
+            rows, cols = matrix.nonzero()
+            for u, v in zip(rows.tolist(), cols.tolist()):
+                yield self._nodes[u], self._nodes[v], label
+
+
+def as_labeled_graph(
+    graph: nx.MultiDiGraph | GraphArrays | LabeledGraph,
+) -> LabeledGraph:
+    if isinstance(graph, LabeledGraph):
+        return graph
+    if isinstance(graph, GraphArrays):
+        return LabeledGraph.from_arrays(graph)
+    return LabeledGraph.from_networkx(graph)
+
+
+def graph_arrays_from_csv(path: str | pathlib.Path) -> GraphArrays:
+    data = pd.read_csv(
+        path, sep=" ", header=None, names=["from", "to", "label"], engine="c"
+    )
+    return GraphArrays.from_edges(
+        data["from"].to_numpy(), data["to"].to_numpy(), data["label"].to_numpy()
+    )
+
+
+def save_graph_arrays(arrays: GraphArrays, path: str | pathlib.Path):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write into a temporary directory first so that a half-written store
+    # is never picked up by open_graph_arrays
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(dir=path.parent))
+    try:
+        for name in _ARRAY_NAMES:
+            np.save(tmp_dir / f"{name}.npy", getattr(arrays, name))
+        with open(tmp_dir / _LABELS_FILE, "w") as f:
+            json.dump(arrays.labels, f)
+        shutil.rmtree(path, ignore_errors=True)
+        tmp_dir.rename(path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def open_graph_arrays(path: str | pathlib.Path) -> GraphArrays:
+    path = pathlib.Path(path)
+    with open(path / _LABELS_FILE) as f:
+        labels = json.load(f)
+    return GraphArrays(
+        **{name: np.load(path / f"{name}.npy", mmap_mode="r") for name in _ARRAY_NAMES},
+        labels=labels,
+    )
+
+
+def load_graph_arrays(name: str, store_dir: str | pathlib.Path = None) -> GraphArrays:
+    path = (
+        pathlib.Path(store_dir or GRAPH_STORE_DIR)
+        / f"v{_GRAPH_STORE_FORMAT_VERSION}"
+        / name
+    )
+    if not (path / _LABELS_FILE).is_file():
+        save_graph_arrays(graph_arrays_from_csv(cd.download(name)), path)
+    return open_graph_arrays(path)
+
+
+def _index_dtype(size: int):
+    return np.int32 if size < np.iinfo(np.int32).max else np.int64
+
+
+def _object_array(values: Iterable) -> np.ndarray:
+    # one element per value, tuples are not unpacked into a second axis
+    return np.fromiter(values, dtype=object)
+
+
+def _values_array(values: Iterable) -> np.ndarray:
+    # numeric columns, such as the ones of a CSV file, keep their dtype
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        return values
+    return _object_array(values)
+
+
+def _to_python_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def graph_nodes(graph: nx.MultiDiGraph | GraphArrays | LabeledGraph) -> list:
+    if isinstance(graph, GraphArrays):
+        return graph.nodes.tolist()
+    return list(graph.nodes)
+
+
+def graph_edges(
+    graph: nx.MultiDiGraph | GraphArrays | LabeledGraph,
+) -> Iterable[tuple[Any, Any, Any]]:
+    if isinstance(graph, GraphArrays | LabeledGraph):
+        return graph.edges()
+    return graph.edges(data="label")
 
 
 def get_graph(name: str):
-    graph_archive = cd.download(name)
-    graph = cd.graph_from_csv(graph_archive)  # loading graph by path
-    return graph
+    return load_graph_arrays(name).to_networkx()
 
 
 def graph_data(graph_name: str):
-    graph = get_graph(graph_name)
+    graph = load_graph_arrays(graph_name)
 
-    nodes = graph.number_of_nodes()
-    edges = graph.number_of_edges()
-    labels = cd.get_sorted_labels(graph)
+    nodes = graph.number_of_nodes
+    edges = graph.number_of_edges
+    labels = graph.sorted_labels()
 
     return nodes, edges, labels
 
@@ -5,8 +5,17 @@ from pyformlang.finite_automaton import (
     Symbol,
 )
 from pyformlang.regular_expression import Regex
-from typing import Set
+from typing import Any, Iterable, Set
 from networkx import MultiDiGraph
+import scipy.sparse as sp
+
+from project.task1 import (
+    GraphArrays,
+    LabeledGraph,
+    as_labeled_graph,
+    graph_edges,
+    graph_nodes,
+)
 
 
 def regex_to_dfa(regex: str) -> DeterministicFiniteAutomaton:
@@ -17,24 +26,83 @@ def regex_to_dfa(regex: str) -> DeterministicFiniteAutomaton:
 
 
 def graph_to_nfa(
-    graph: MultiDiGraph, start_states: Set[int] = None, final_states: Set[int] = None
+    graph: MultiDiGraph | GraphArrays | LabeledGraph,
+    start_states: Set[int] = None,
+    final_states: Set[int] = None,
 ) -> NondeterministicFiniteAutomaton:
     nfa = NondeterministicFiniteAutomaton()
 
-    for u, v, data in graph.edges(data=True):
-        symbol = Symbol(data.get("label", ""))
+    for u, v, label in graph_edges(graph):
+        symbol = Symbol(label if label is not None else "")
         nfa.add_transition(State(u), symbol, State(v))
 
     if not start_states:
-        start_states = set(graph.nodes)
+        start_states = set(graph_nodes(graph))
 
     for state in start_states:
         nfa.add_start_state(State(state))
 
     if not final_states:
-        final_states = set(graph.nodes)
+        final_states = set(graph_nodes(graph))
 
     for state in final_states:
         nfa.add_final_state(State(state))
 
     return nfa
+
+
+class GraphAutomaton:
+    # State i of the automaton is the graph node graph.nodes[i], transitions
+    # by a label are the graph's CSR matrix for that label
+    _graph: LabeledGraph
+    _start_states: set[int]
+    _final_states: set[int]
+
+    def __init__(
+        self,
+        graph: LabeledGraph,
+        start_states: Iterable = None,
+        final_states: Iterable = None,
+    ):
+        self._graph = graph
+        self._start_states = self.__to_states(start_states)
+        self._final_states = self.__to_states(final_states)
+
+    def __to_states(self, nodes: Iterable) -> set[int]:
+        if not nodes:
+            return set(self.states)
+        return set(self._graph.indices(nodes).tolist())
+
+    @property
+    def graph(self) -> LabeledGraph:
+        return self._graph
+
+    @property
+    def states(self) -> range:
+        return range(self._graph.number_of_nodes)
+
+    @property
+    def start_states(self) -> set[int]:
+        return self._start_states
+
+    @property
+    def final_states(self) -> set[int]:
+        return self._final_states
+
+    @property
+    def symbols(self) -> list:
+        return self._graph.labels
+
+    def transitions(self, symbol) -> sp.csr_matrix:
+        return self._graph.matrices[symbol]
+
+    def state_to_node(self, state: int) -> Any:
+        return self._graph.nodes[state]
+
+
+def graph_to_automaton(
+    graph: MultiDiGraph | GraphArrays | LabeledGraph,
+    start_states: Set[int] = None,
+    final_states: Set[int] = None,
+) -> GraphAutomaton:
+    return GraphAutomaton(as_labeled_graph(graph), start_states, final_states)
@@ -1,16 +1,257 @@
-from collections import defaultdict
-from dataclasses import dataclass
-from itertools import product
-from typing import Iterable, List, Optional, Self, Generic, TypeVar, cast
+from collections import OrderedDict, defaultdict
+from functools import partial
+from typing import Iterable, List, Optional, Self, Generic, TypeVar
 from networkx import MultiDiGraph
-from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, State, Symbol
+from pyformlang.finite_automaton import (
+    DeterministicFiniteAutomaton,
+    NondeterministicFiniteAutomaton,
+    State,
+    Symbol,
+)
+import numpy as np
 import scipy.sparse as sp
+import scipy.sparse.csgraph as csgraph
 
-from project.task2 import regex_to_dfa, graph_to_nfa
+from project.backends import (
+    BooleanMatrixBackend,
+    backend_transitive_closure,
+    get_backend,
+)
+from project.bitmatrix import to_csr
+from project.task1 import GraphArrays, LabeledGraph
+from project.task2 import GraphAutomaton, graph_to_automaton, regex_to_dfa
 
 Matrix = TypeVar("Matrix")
 
 
+def bool_matrix(
+    rows: Iterable[int],
+    cols: Iterable[int],
+    shape: tuple[int, int],
+    matrix_type: Matrix = sp.csr_matrix,
+) -> Matrix:
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    matrix = sp.csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)), shape=shape, dtype=bool
+    )
+    return matrix if matrix_type is sp.csr_matrix else matrix_type(matrix)
+
+
+def csr_successors(
+    matrix: sp.csr_matrix, rows: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    # all (k, col) such that matrix[rows[k], col] is set
+    begins = matrix.indptr[rows]
+    counts = matrix.indptr[rows + 1] - begins
+    owners = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, matrix.indices[begins[owners] + offsets]
+
+
+def _product_successors(
+    matrix1: sp.csr_matrix,
+    matrix2: sp.csr_matrix,
+    rows1: np.ndarray,
+    rows2: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # successors of the pairs (rows1[k], rows2[k]) in the Kronecker product
+    # of the two matrices, read straight from their CSR rows
+    begins1, begins2 = matrix1.indptr[rows1], matrix2.indptr[rows2]
+    counts1 = matrix1.indptr[rows1 + 1] - begins1
+    counts2 = matrix2.indptr[rows2 + 1] - begins2
+    totals = counts1 * counts2
+    owners = np.repeat(np.arange(len(rows1)), totals)
+    offsets = np.arange(totals.sum()) - np.repeat(np.cumsum(totals) - totals, totals)
+    width = counts2[owners]
+    left = matrix1.indices[begins1[owners] + offsets // width]
+    right = matrix2.indices[begins2[owners] + offsets % width]
+    return owners, left, right
+
+
+BFS_DIRECTIONS = {"push", "pull", "auto"}
+# Beamer's alpha: a level is pulled once the edges leaving the front
+# outnumber the unvisited entries alpha times and all entries, which are
+# scanned to find the unvisited ones
+PULL_ALPHA = 50
+# predecessors tried one at a time before the rest are expanded at once
+PULL_ROUNDS = 4
+
+
+def _check_direction(direction: str):
+    if direction not in BFS_DIRECTIONS:
+        raise ValueError(
+            f"Unknown BFS direction {direction!r}, "
+            f"expected one of {sorted(BFS_DIRECTIONS)}"
+        )
+
+
+def use_pull(direction: str, front_edges: int, unvisited: int, entries: int) -> bool:
+    return direction == "pull" or (
+        direction == "auto"
+        and front_edges > PULL_ALPHA * unvisited
+        and front_edges > entries
+    )
+
+
+def pull_hits(
+    transposed: sp.csr_matrix,
+    rows: np.ndarray,
+    targets: np.ndarray,
+    front_mask: np.ndarray,
+    width: int,
+) -> np.ndarray:
+    # bottom-up step: marks the pairs (rows[k], targets[k]) such that
+    # front_mask[rows[k] * width + p] is set for a predecessor p of
+    # targets[k]; the first predecessors are tried one at a time, so on
+    # a dense front most pairs stop at an early hit
+    begins = transposed.indptr[targets]
+    ends = transposed.indptr[targets + 1]
+    hits = np.zeros(len(rows), dtype=bool)
+    pending = np.arange(len(rows))
+    positions = begins[pending]
+    for _ in range(PULL_ROUNDS):
+        live = positions < ends[pending]
+        pending, positions = pending[live], positions[live]
+        if not len(pending):
+            return hits
+        hit = front_mask[rows[pending] * width + transposed.indices[positions]]
+        hits[pending[hit]] = True
+        pending, positions = pending[~hit], positions[~hit] + 1
+
+    counts = np.maximum(ends[pending] - positions, 0)
+    owners = np.repeat(np.arange(len(pending)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    predecessors = transposed.indices[positions[owners] + offsets]
+    hit = front_mask[rows[pending][owners] * width + predecessors]
+    hits[pending[owners[hit]]] = True
+    return hits
+
+
+def entries_mask(
+    rows: np.ndarray, cols: np.ndarray, shape: tuple[int, int]
+) -> np.ndarray:
+    # flat bitmap of the entries, indexed by row * width + col
+    mask = np.zeros(shape[0] * shape[1], dtype=bool)
+    mask[np.asarray(rows, dtype=np.int64) * shape[1] + cols] = True
+    return mask
+
+
+def unvisited_entries(
+    visited_rows: np.ndarray,
+    visited_cols: np.ndarray,
+    shape: tuple[int, int],
+    cols_mask: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    # complement of the visited entries in the columns of cols_mask; only
+    # built on pulled levels, where it is small next to the work of a push
+    mask = np.tile(cols_mask, shape[0])
+    mask[np.asarray(visited_rows, dtype=np.int64) * shape[1] + visited_cols] = False
+    return np.divmod(np.flatnonzero(mask), shape[1])
+
+
+def expand_front(
+    front: sp.csr_matrix,
+    visited: sp.csr_matrix,
+    matrix: sp.csr_matrix,
+    transposed: sp.csr_matrix,
+    direction: str = "auto",
+) -> sp.csr_matrix:
+    # entries of front @ matrix that are not visited yet, either pushed
+    # along the rows of matrix or pulled into the unvisited entries along
+    # the rows of its transpose
+    rows_number, width = front.shape
+    entries = rows_number * width
+    front_edges = int(np.diff(matrix.indptr)[front.indices].sum())
+    if not use_pull(direction, front_edges, entries - visited.nnz, entries):
+        return (front @ matrix) > visited
+    front_mask = entries_mask(*front.nonzero(), front.shape)
+    rows, targets = unvisited_entries(
+        *visited.nonzero(), front.shape, np.diff(transposed.indptr) > 0
+    )
+    hits = pull_hits(transposed, rows, targets, front_mask, width)
+    return bool_matrix(rows[hits], targets[hits], front.shape)
+
+
+def _closure_bfs(matrix: sp.csr_matrix, direction: str = "auto") -> sp.csr_matrix:
+    # level-synchronous BFS from every vertex at once
+    _check_direction(direction)
+    transposed = sp.csr_matrix(matrix.T)
+    visited = sp.identity(matrix.shape[0], dtype=bool, format="csr")
+    front = visited
+    while front.nnz:
+        front = expand_front(front, visited, matrix, transposed, direction)
+        visited = visited + front
+    return visited
+
+
+def _topological_order(dag: sp.csr_matrix) -> list[int]:
+    indegree = np.bincount(dag.indices, minlength=dag.shape[0])
+    stack = np.flatnonzero(indegree == 0).tolist()
+    order = []
+    while stack:
+        vertex = stack.pop()
+        order.append(vertex)
+        successors = dag.indices[dag.indptr[vertex] : dag.indptr[vertex + 1]]
+        indegree[successors] -= 1
+        stack.extend(successors[indegree[successors] == 0].tolist())
+    return order
+
+
+def _closure_scc(matrix: sp.csr_matrix) -> sp.csr_matrix:
+    # every vertex of a strongly connected component reaches the same set,
+    # so the closure is computed on the condensation DAG and expanded back
+    states_number = matrix.shape[0]
+    components_number, labels = csgraph.connected_components(
+        matrix, directed=True, connection="strong"
+    )
+    membership = bool_matrix(
+        np.arange(states_number), labels, (states_number, components_number)
+    )
+    condensed = (membership.T @ matrix @ membership).tocoo()
+    not_loop = condensed.row != condensed.col
+    dag = bool_matrix(
+        condensed.row[not_loop],
+        condensed.col[not_loop],
+        (components_number, components_number),
+    )
+
+    reachable = [None] * components_number
+    for component in reversed(_topological_order(dag)):
+        successors = dag.indices[dag.indptr[component] : dag.indptr[component + 1]]
+        reachable[component] = np.unique(
+            np.concatenate([[component], *(reachable[s] for s in successors)])
+        )
+
+    lengths = [len(row) for row in reachable]
+    components_closure = bool_matrix(
+        np.repeat(np.arange(components_number), lengths),
+        np.concatenate(reachable) if reachable else [],
+        (components_number, components_number),
+    )
+    return membership @ components_closure @ membership.T
+
+
+CLOSURE_STRATEGIES = {
+    "squaring": partial(backend_transitive_closure, get_backend("scipy")),
+    "scc": _closure_scc,
+    "bfs": _closure_bfs,
+}
+
+
+def transitive_closure(matrix, strategy: str = "squaring") -> sp.csr_matrix:
+    if strategy not in CLOSURE_STRATEGIES:
+        raise ValueError(
+            f"Unknown closure strategy {strategy!r}, "
+            f"expected one of {sorted(CLOSURE_STRATEGIES)}"
+        )
+    matrix = sp.csr_matrix(matrix, dtype=bool)
+    matrix.eliminate_zeros()
+    if matrix.shape[0] == 0:
+        return matrix
+    return CLOSURE_STRATEGIES[strategy](matrix)
+
+
 class AdjacencyMatrixFA(Generic[Matrix]):
     _matrix_type: Matrix
     _adj_matrices: dict[Symbol, Matrix]
@@ -19,36 +260,71 @@ class AdjacencyMatrixFA(Generic[Matrix]):
     _final_states: set[int]
     _states_to_num: dict[State, int]
     _num_to_state: List[State]
+    _csr_matrices: dict[Symbol, sp.csr_matrix]
+    _transposed_matrices: dict[Symbol, sp.csr_matrix]
+    # automata of a product, whose states are decoded arithmetically
+    _factors: Optional[tuple["AdjacencyMatrixFA", "AdjacencyMatrixFA"]]
 
     @staticmethod
     def __enumerate_value(value) -> dict[State, int]:
         return {val: idx for idx, val in enumerate(value)}
 
     def __get_symbol_adj_matrix_dict(self, nfa) -> dict[Symbol, Matrix]:
-        symbol_state = defaultdict(
-            lambda: self._matrix_type((len(nfa.states), len(nfa.states)), dtype=bool)
-        )
+        transitions = defaultdict(lambda: ([], []))
         for start_state, value in nfa.to_dict().items():
+            start_state_int = self._states_to_num[start_state]
             for symbol, end_states in value.items():
-                start_state_int = self._states_to_num[start_state]
                 if type(end_states) is State:
                     end_states = {end_states}
+                rows, cols = transitions[symbol]
                 for end_st in end_states:
-                    end_state_int = self._states_to_num[end_st]
-                    symbol_state[symbol][start_state_int, end_state_int] = True
-        return symbol_state
+                    rows.append(start_state_int)
+                    cols.append(self._states_to_num[end_st])
+        return self._bulk_adj_matrices(transitions)
+
+    def _bulk_adj_matrices(
+        self, transitions: dict[Symbol, tuple[Iterable[int], Iterable[int]]]
+    ) -> dict[Symbol, Matrix]:
+        shape = (self._states_number, self._states_number)
+        return {
+            symbol: bool_matrix(rows, cols, shape, self._matrix_type)
+            for symbol, (rows, cols) in transitions.items()
+        }
+
+    def __init_from_graph(self, automaton: GraphAutomaton):
+        # graph states are node indices already, so no State objects are
+        # needed; graph matrices are sparse and stay CSR whatever matrix_type
+        # is, converting them costs more than any query on them
+        self._states_to_num = automaton.graph.node_to_index
+        self._num_to_state = automaton.graph.nodes
+        self._states_number = len(automaton.states)
+        self._start_states = automaton.start_states
+        self._final_states = automaton.final_states
+        self._adj_matrices = {
+            Symbol(symbol if symbol is not None else ""): automaton.transitions(symbol)
+            for symbol in automaton.symbols
+        }
 
     def __init__(
         self,
-        nfa: Optional[NondeterministicFiniteAutomaton],
+        nfa: Optional[NondeterministicFiniteAutomaton | GraphAutomaton],
         matrix_type: Matrix = sp.lil_matrix,
     ):
         self._matrix_type = matrix_type
         self._adj_matrices = dict()
+        self._csr_matrices = dict()
+        self._transposed_matrices = dict()
+        self._factors = None
         if nfa is None:
             self._states_number = 0
             self._start_states = set()
             self._final_states = set()
+            self._states_to_num = None
+            self._num_to_state = None
+            return
+
+        if isinstance(nfa, GraphAutomaton):
+            self.__init_from_graph(nfa)
             return
 
         self._states_to_num = self.__enumerate_value(nfa.states)
@@ -61,105 +337,184 @@ class AdjacencyMatrixFA(Generic[Matrix]):
 
         self._adj_matrices = self.__get_symbol_adj_matrix_dict(nfa)
 
-    def __dfs_find_path(self, word: Iterable[Symbol]):
-        @dataclass
-        class Configuration:
-            word: List[Symbol]
-            state: int
-
-        stack = [
-            Configuration(list(word), start_state) for start_state in self._start_states
-        ]
-
-        while len(stack):
-            cur_conf = stack.pop()
-
-            if not len(cur_conf.word):
-                if cur_conf.state in self._final_states:
-                    return True
-                continue
-
-            next_symbol = cur_conf.word[0]
-            if next_symbol not in self._adj_matrices.keys():
-                continue
-
-            for i in range(self._states_number):
-                if self._adj_matrices[next_symbol][cur_conf.state, i]:
-                    stack.append(Configuration(cur_conf.word[1:], i))
+    def _csr_matrix(self, symbol: Symbol) -> sp.csr_matrix:
+        # CSR copies of the symbol matrices for row-oriented simulation
+        matrix = self._csr_matrices.get(symbol)
+        if matrix is None:
+            matrix = to_csr(self._adj_matrices[symbol])
+            self._csr_matrices[symbol] = matrix
+        return matrix
+
+    def _transposed_matrix(self, symbol: Symbol) -> sp.csr_matrix:
+        # rows are predecessors, used by backward searches and pulled BFS levels
+        matrix = self._transposed_matrices.get(symbol)
+        if matrix is None:
+            matrix = sp.csr_matrix(self._csr_matrix(symbol).T)
+            self._transposed_matrices[symbol] = matrix
+        return matrix
+
+    def accepts_many(self, words: Iterable[Iterable[Symbol]]) -> list[bool]:
+        # row i of the configuration matrix is the set of states reached
+        # after reading the prefix of words[i] processed so far
+        words = [list(word) for word in words]
+        lengths = np.array([len(word) for word in words], dtype=np.int64)
+        words_number = len(words)
+        shape = (words_number, self._states_number)
+        final_states = np.fromiter(self._final_states, dtype=np.int64)
+        start_states = np.fromiter(self._start_states, dtype=np.int64)
+
+        configurations = bool_matrix(
+            np.repeat(np.arange(words_number), len(start_states)),
+            np.tile(start_states, words_number),
+            shape,
+        )
+        accepted = np.zeros(words_number, dtype=bool)
+        for step in range(int(lengths.max(initial=0)) + 1):
+            finished = np.flatnonzero(lengths == step)
+            accepted[finished] = (
+                configurations[finished][:, final_states].getnnz(axis=1) > 0
+            )
 
-        return False
+            by_symbol = defaultdict(list)
+            for i in np.flatnonzero(lengths > step).tolist():
+                by_symbol[words[i][step]].append(i)
+
+            rows, cols = [], []
+            for symbol, word_indices in by_symbol.items():
+                if symbol not in self._adj_matrices:
+                    continue
+                moved = (
+                    configurations[word_indices] @ self._csr_matrix(symbol)
+                ).tocoo()
+                rows.append(np.asarray(word_indices)[moved.row])
+                cols.append(moved.col)
+            configurations = bool_matrix(
+                np.concatenate(rows) if rows else [],
+                np.concatenate(cols) if cols else [],
+                shape,
+            )
+        return accepted.tolist()
 
     def accepts(self, word: Iterable[Symbol]) -> bool:
-        return self.__dfs_find_path(word)
-
-    def __pow_closure(self, matrix):
-        cur = matrix
-        power = 1
-        for i in range(2, self._states_number + 1):
-            power *= i
-            prev = cur
-            cur = sp.linalg.matrix_power(prev, i)
-            if power > self._states_number:
-                break
-            if prev.nnz == cur.nnz:
-                if (cur != prev).nnz == 0:
-                    break
-        return cur
-
-    def transitive_closure(self) -> Matrix:
+        states = np.zeros(self._states_number, dtype=bool)
+        states[list(self._start_states)] = True
+        for symbol in word:
+            if symbol not in self._adj_matrices or not states.any():
+                return False
+            states = self._csr_matrix(symbol).T @ states
+        return bool(states[list(self._final_states)].any())
+
+    def _adjacency_union(self) -> sp.csr_matrix:
+        union = sp.csr_matrix((self._states_number, self._states_number), dtype=bool)
+        for matrix in self._adj_matrices.values():
+            union = union + to_csr(matrix)
+        return union
+
+    def transitive_closure(self, strategy: str = "squaring") -> sp.csr_matrix:
         if self._adj_matrices:
-            sum_matrix = cast(Matrix, sum(self._adj_matrices.values()))
-            sum_matrix.setdiag(True)
-            res = self.__pow_closure(sum_matrix)
-            return res
+            return transitive_closure(self._adjacency_union(), strategy)
         else:
-            return sp.identity(self._states_number)
+            return sp.identity(self._states_number, dtype=bool, format="csr")
+
+    def shortest_accepting_path_length(self) -> Optional[int]:
+        final = np.zeros(self._states_number, dtype=bool)
+        final[list(self._final_states)] = True
+        visited = np.zeros(self._states_number, dtype=bool)
+        front = np.fromiter(self._start_states, dtype=np.int64)
+        visited[front] = True
+        adjacency = self._adjacency_union()
+
+        length = 0
+        while len(front):
+            if final[front].any():
+                return length
+            front = np.unique(adjacency[front].indices)
+            front = front[~visited[front]]
+            visited[front] = True
+            length += 1
+        return None
 
     def is_empty(self) -> bool:
-        if not self._adj_matrices:
-            return True
-        transitive_closure_matrix = self.transitive_closure()
+        return self.shortest_accepting_path_length() is None
+
+    @classmethod
+    def from_transitions(
+        cls,
+        states_number: int,
+        transitions: dict[Symbol, tuple[Iterable[int], Iterable[int]]],
+        start_states: Iterable[int],
+        final_states: Iterable[int],
+        matrix_type: Matrix = sp.lil_matrix,
+    ):
+        instance = cls(None, matrix_type)
+        instance._num_to_state = [State(i) for i in range(states_number)]
+        instance._states_to_num = {
+            state: idx for idx, state in enumerate(instance._num_to_state)
+        }
+        instance._states_number = states_number
+        instance._start_states = set(start_states)
+        instance._final_states = set(final_states)
+        instance._adj_matrices = instance._bulk_adj_matrices(transitions)
+        return instance
 
-        return not any(
-            transitive_closure_matrix[s, e]
-            for s, e in product(self._start_states, self._final_states)
+    @classmethod
+    def from_edges(
+        cls,
+        src: Iterable,
+        dst: Iterable,
+        labels: Iterable,
+        start_nodes: Iterable = None,
+        final_nodes: Iterable = None,
+        matrix_type: Matrix = sp.lil_matrix,
+    ):
+        return cls.from_labeled_graph(
+            LabeledGraph.from_edges(src, dst, labels),
+            start_nodes,
+            final_nodes,
+            matrix_type,
         )
 
+    @classmethod
+    def from_labeled_graph(
+        cls,
+        graph: LabeledGraph,
+        start_nodes: Iterable = None,
+        final_nodes: Iterable = None,
+        matrix_type: Matrix = sp.lil_matrix,
+    ):
+        return cls(GraphAutomaton(graph, start_nodes, final_nodes), matrix_type)
+
     @classmethod
     def from_intersect(
         cls, automaton1: Self, automaton2: Self, matrix_type: Matrix = sp.lil_matrix
     ):
         instance = cls(None, matrix_type)
-        united_syms = [
-            sym
-            for sym in set(automaton1._adj_matrices.keys()).intersection(
-                automaton2._adj_matrices.keys()
-            )
-        ]
+        instance._factors = (automaton1, automaton2)
+        united_syms = set(automaton1._adj_matrices.keys()).intersection(
+            automaton2._adj_matrices.keys()
+        )
 
         instance._adj_matrices = {
             sym: instance._matrix_type(
-                sp.kron(automaton1._adj_matrices[sym], automaton2._adj_matrices[sym])
+                sp.kron(
+                    to_csr(automaton1._adj_matrices[sym]),
+                    to_csr(automaton2._adj_matrices[sym]),
+                    format="csr",
+                )
             )
             for sym in united_syms
         }
 
-        def state_to_num(st1, st2):
-            return st1 * automaton2._states_number + st2
-
+        # pair (st1, st2) is the state st1 * |Q2| + st2
         def intersect_states(states1, states2):
-            return set(state_to_num(st1, st2) for st1, st2 in product(states1, states2))
-
-        instance._states_to_num = {
-            State((st1[0], st2[0])): state_to_num(st1[1], st2[1])
-            for st1, st2 in product(
-                automaton1._states_to_num.items(), automaton2._states_to_num.items()
+            return set(
+                np.add.outer(
+                    np.fromiter(states1, dtype=np.int64) * automaton2._states_number,
+                    np.fromiter(states2, dtype=np.int64),
+                )
+                .ravel()
+                .tolist()
             )
-        }
-        instance._num_to_state = [
-            State(el)
-            for el in product(automaton1._num_to_state, automaton2._num_to_state)
-        ]
 
         instance._start_states = intersect_states(
             automaton1._start_states, automaton2._start_states
@@ -170,6 +525,14 @@ class AdjacencyMatrixFA(Generic[Matrix]):
         instance._states_number = automaton1._states_number * automaton2._states_number
         return instance
 
+    def product_states(self, states: Iterable[int]) -> tuple[np.ndarray, np.ndarray]:
+        # states of both factors for the given states of a product automaton
+        if self._factors is None:
+            raise ValueError("Automaton is not a product of two automata")
+        return np.divmod(
+            np.asarray(states, dtype=np.int64), self._factors[1].states_number
+        )
+
     @property
     def states_number(self):
         return self._states_number
@@ -184,6 +547,10 @@ class AdjacencyMatrixFA(Generic[Matrix]):
 
     @property
     def states_to_num(self):
+        if self._states_to_num is None and self._factors is not None:
+            self._states_to_num = {
+                state: idx for idx, state in enumerate(self.num_to_state)
+            }
         return self._states_to_num
 
     @property
@@ -192,37 +559,255 @@ class AdjacencyMatrixFA(Generic[Matrix]):
 
     @property
     def num_to_state(self):
+        if self._num_to_state is None and self._factors is not None:
+            # State objects of a product are only built when asked for
+            automaton1, automaton2 = self._factors
+            left, right = self.product_states(np.arange(self._states_number))
+            self._num_to_state = [
+                State((automaton1.num_to_state[i], automaton2.num_to_state[j]))
+                for i, j in zip(left.tolist(), right.tolist())
+            ]
         return self._num_to_state
 
 
+class LazyIntersectionFA(AdjacencyMatrixFA):
+    # product automaton restricted to the pairs reachable from the start
+    # pairs; pair (i, j) is keyed by i * |Q2| + j while exploring and the
+    # reached keys are then renumbered densely in sorted order
+    _left_states: np.ndarray
+    _right_states: np.ndarray
+
+    def __init__(
+        self,
+        automaton1: AdjacencyMatrixFA,
+        automaton2: AdjacencyMatrixFA,
+        matrix_type: Matrix = sp.lil_matrix,
+    ):
+        super().__init__(None, matrix_type)
+        self._factors = (automaton1, automaton2)
+        width = automaton2.states_number
+        symbols = set(automaton1.adj_matrices.keys()).intersection(
+            automaton2.adj_matrices.keys()
+        )
+
+        starts = np.unique(
+            np.add.outer(
+                np.fromiter(automaton1.start_states, dtype=np.int64) * width,
+                np.fromiter(automaton2.start_states, dtype=np.int64),
+            ).ravel()
+        )
+        # a bitmap over all pair keys, so that every level is filtered in
+        # time proportional to its own size
+        visited = np.zeros(automaton1.states_number * width, dtype=bool)
+        visited[starts] = True
+        front = starts
+        empty = np.empty(0, dtype=np.int64)
+        edges = {symbol: ([empty], [empty]) for symbol in symbols}
+        while len(front):
+            left, right = np.divmod(front, width)
+            reached = []
+            for symbol in symbols:
+                owners, next_left, next_right = _product_successors(
+                    automaton1._csr_matrix(symbol),
+                    automaton2._csr_matrix(symbol),
+                    left,
+                    right,
+                )
+                targets = next_left * width + next_right
+                edges[symbol][0].append(front[owners])
+                edges[symbol][1].append(targets)
+                reached.append(targets)
+            reached = np.concatenate(reached) if reached else empty
+            front = np.unique(reached[~visited[reached]])
+            visited[front] = True
+
+        visited = np.flatnonzero(visited)
+        self._states_number = len(visited)
+        self._left_states, self._right_states = np.divmod(visited, width)
+        shape = (self._states_number, self._states_number)
+        self._adj_matrices = {
+            symbol: bool_matrix(
+                np.searchsorted(visited, np.concatenate(sources)),
+                np.searchsorted(visited, np.concatenate(targets)),
+                shape,
+                matrix_type,
+            )
+            for symbol, (sources, targets) in edges.items()
+        }
+
+        final1 = np.zeros(automaton1.states_number, dtype=bool)
+        final1[list(automaton1.final_states)] = True
+        final2 = np.zeros(automaton2.states_number, dtype=bool)
+        final2[list(automaton2.final_states)] = True
+        self._start_states = set(np.searchsorted(visited, starts).tolist())
+        self._final_states = set(
+            np.flatnonzero(
+                final1[self._left_states] & final2[self._right_states]
+            ).tolist()
+        )
+
+    @property
+    def left_states(self) -> np.ndarray:
+        return self._left_states
+
+    @property
+    def right_states(self) -> np.ndarray:
+        return self._right_states
+
+    def product_states(self, states: Iterable[int]) -> tuple[np.ndarray, np.ndarray]:
+        states = np.asarray(states, dtype=np.int64)
+        return self._left_states[states], self._right_states[states]
+
+
+class RegexCache:
+    # LRU cache of compiled regexes: the minimized DFA and its adjacency
+    # matrices for every matrix type requested so far
+    _maxsize: int
+    _entries: OrderedDict[str, dict]
+    hits: int
+    misses: int
+
+    def __init__(self, maxsize: int = 128):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(regex: str) -> str:
+        return " ".join(regex.split())
+
+    def __entry(self, regex: str) -> dict:
+        key = self.normalize(regex)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = {"dfa": regex_to_dfa(key), "adjacency": {}}
+            self._entries[key] = entry
+            if len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    def __count(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def dfa(self, regex: str) -> DeterministicFiniteAutomaton:
+        self.__count(self.normalize(regex) in self._entries)
+        return self.__entry(regex)["dfa"]
+
+    def adjacency(
+        self, regex: str, matrix_type: Matrix = sp.lil_matrix
+    ) -> AdjacencyMatrixFA:
+        key = self.normalize(regex)
+        self.__count(
+            key in self._entries and matrix_type in self._entries[key]["adjacency"]
+        )
+        entry = self.__entry(regex)
+        if matrix_type not in entry["adjacency"]:
+            entry["adjacency"][matrix_type] = AdjacencyMatrixFA(
+                entry["dfa"], matrix_type
+            )
+        return entry["adjacency"][matrix_type]
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+regex_cache = RegexCache()
+
+
 def intersect_automata(
     automaton1: AdjacencyMatrixFA, automaton2: AdjacencyMatrixFA
 ) -> AdjacencyMatrixFA:
     return AdjacencyMatrixFA.from_intersect(automaton1, automaton2)
 
 
+RESULT_FORMATS = {"set", "arrays", "matrix"}
+# "arrays" and "matrix" come with the list of graph nodes their indices
+# point into
+RpqResult = (
+    set[tuple] | tuple[list, np.ndarray, np.ndarray] | tuple[list, sp.csr_matrix]
+)
+
+
+def state_mask(states: Iterable[int], states_number: int) -> np.ndarray:
+    mask = np.zeros(states_number, dtype=bool)
+    mask[np.fromiter(states, dtype=np.int64)] = True
+    return mask
+
+
+def rpq_result(
+    graph_fa: AdjacencyMatrixFA,
+    sources: np.ndarray,
+    targets: np.ndarray,
+    result_format: str = "set",
+) -> RpqResult:
+    # sources and targets are graph states of the answer pairs, duplicates
+    # allowed; "set" gives the pairs of nodes, "arrays" gives
+    # (nodes, sources, targets) and "matrix" gives (nodes, matrix), where
+    # sources, targets and the matrix indices are int64 positions in nodes
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(
+            f"Unknown result format {result_format!r}, "
+            f"expected one of {sorted(RESULT_FORMATS)}"
+        )
+    states_number = graph_fa.states_number
+    nodes = list(graph_fa.num_to_state)
+    if result_format == "matrix":
+        return nodes, bool_matrix(sources, targets, (states_number, states_number))
+
+    pairs = np.unique(np.asarray(sources, dtype=np.int64) * states_number + targets)
+    sources, targets = np.divmod(pairs, max(states_number, 1))
+    if result_format == "arrays":
+        return nodes, sources, targets
+    nodes = np.fromiter(nodes, dtype=object, count=states_number)
+    return set(zip(nodes[sources].tolist(), nodes[targets].tolist()))
+
+
 def tensor_based_rpq(
     regex: str,
-    graph: MultiDiGraph,
+    graph: MultiDiGraph | GraphArrays | LabeledGraph,
     start_nodes: set[int],
     final_nodes: set[int],
     matrix_type=sp.lil_matrix,
-) -> set[tuple[int, int]]:
-    regex_dfa = regex_to_dfa(regex)
-    adj_regex = AdjacencyMatrixFA(regex_dfa, matrix_type)
-    graph_nfa = graph_to_nfa(graph, start_nodes, final_nodes)
-    adj_graph = AdjacencyMatrixFA(graph_nfa, matrix_type)
-    adj_intersect = AdjacencyMatrixFA.from_intersect(adj_graph, adj_regex, matrix_type)
-
-    adj_closure = adj_intersect.transitive_closure()
-
-    result = {
-        (
-            adj_intersect.num_to_state[start].value[0],
-            adj_intersect.num_to_state[final].value[0],
+    closure_strategy: str = "squaring",
+    result_format: str = "set",
+    backend: str | BooleanMatrixBackend = "scipy",
+) -> RpqResult:
+    # the graph and the product are as sparse as the graph and stay CSR,
+    # only the regex automaton takes matrix_type
+    adj_regex = regex_cache.adjacency(regex, matrix_type)
+    adj_graph = AdjacencyMatrixFA(graph_to_automaton(graph, start_nodes, final_nodes))
+    adj_intersect = LazyIntersectionFA(adj_graph, adj_regex, sp.csr_matrix)
+
+    backend = get_backend(backend)
+    if backend.name == "scipy":
+        adj_closure = adj_intersect.transitive_closure(closure_strategy)
+    elif closure_strategy != "squaring":
+        raise ValueError(
+            f"Closure strategy {closure_strategy!r} needs the scipy backend"
         )
-        for start, final in zip(*adj_closure.nonzero())
-        if start in adj_intersect.start_states and final in adj_intersect.final_states
-    }
+    else:
+        adj_closure = backend_transitive_closure(
+            backend, backend.from_scipy(adj_intersect._adjacency_union())
+        )
+
+    sources, targets = backend.nonzero(adj_closure)
+    states_number = adj_intersect.states_number
+    keep = (
+        state_mask(adj_intersect.start_states, states_number)[sources]
+        & state_mask(adj_intersect.final_states, states_number)[targets]
+    )
+    graph_sources, _ = adj_intersect.product_states(sources[keep])
+    graph_targets, _ = adj_intersect.product_states(targets[keep])
 
-    return result
+    return rpq_result(adj_graph, graph_sources, graph_targets, result_format)
@@ -1,117 +1,760 @@
-from copy import copy
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from functools import reduce
-from typing import Generic, TypeVar
+from typing import Any, Callable, Generic, Iterable, Optional, TypeVar
 from networkx import MultiDiGraph
 from pyformlang.finite_automaton import Symbol
+import numpy as np
 import scipy.sparse as sp
 
-from project.task2 import regex_to_dfa, graph_to_nfa
-from project.task3 import AdjacencyMatrixFA
+from project.backends import (
+    BooleanMatrixBackend,
+    backend_for_matrix_type,
+)
+from project.task1 import (
+    GraphArrays,
+    LabeledGraph,
+    as_labeled_graph,
+    graph_edges,
+    graph_nodes,
+)
+from project.task2 import GraphAutomaton, graph_to_automaton
+from project.task3 import (
+    AdjacencyMatrixFA,
+    _check_direction,
+    bool_matrix,
+    csr_successors,
+    entries_mask,
+    pull_hits,
+    RpqResult,
+    regex_cache,
+    rpq_result,
+    state_mask,
+    unvisited_entries,
+    use_pull,
+)
 
 Matrix = TypeVar("Matrix")
 
 
 class MsBfsRpq(Generic[Matrix]):
-    __matrix_type: Matrix
+    __backend: BooleanMatrixBackend
     __adj_dfa: AdjacencyMatrixFA
     __adj_nfa: AdjacencyMatrixFA
     __shift: int
     __united_symbols: set[Symbol]
+    __symbols: list[Symbol]
+    __direction: str
+    __degrees: Optional[tuple[np.ndarray, np.ndarray]]
+    __recorded: Optional[np.ndarray]
+    __parents: Optional[tuple[np.ndarray, np.ndarray, np.ndarray]]
 
     def __init__(
         self,
         adj_dfa: AdjacencyMatrixFA,
-        adj_nfa: AdjacencyMatrixFA,
+        adj_nfa: AdjacencyMatrixFA | GraphAutomaton,
         matrix_type=sp.csr_matrix,
+        start_states: Optional[Iterable[int]] = None,
+        record_parents: bool = False,
+        witness_sources: Optional[Iterable] = None,
+        backend: Optional[str | BooleanMatrixBackend] = None,
+        direction: str = "auto",
     ):
-        self.__matrix_type = matrix_type
+        _check_direction(direction)
+        if isinstance(adj_nfa, GraphAutomaton):
+            adj_nfa = AdjacencyMatrixFA(adj_nfa)
+        # fronts live on the backend, graph matrices are kept as CSR; a given
+        # backend wins over matrix_type, which only picks the default one
+        self.__backend = backend_for_matrix_type(matrix_type, backend)
         self.__adj_dfa = adj_dfa
         self.__adj_nfa = adj_nfa
-        self.__start_states_list = list(adj_nfa.start_states)
+        # a subset of the start states lets a query run in several batches
+        self.__start_states_list = list(
+            adj_nfa.start_states if start_states is None else start_states
+        )
         self.__shift = self.__adj_dfa.states_number
         self.__united_symbols = set(self.__adj_dfa.adj_matrices.keys()).intersection(
             self.__adj_nfa.adj_matrices.keys()
         )
-        self.__permutation_matrices = {
-            symbol: sp.block_diag(
-                [
-                    adj_dfa.adj_matrices[symbol].transpose()
-                    for _ in self.__start_states_list
+        self.__symbols = list(self.__united_symbols)
+        self.__direction = direction
+        # graph out-degrees and DFA transitions by symbol, to weigh a front
+        self.__degrees = (
+            None
+            if direction == "push" or not self.__symbols
+            else tuple(
+                np.column_stack(
+                    [
+                        np.diff(automaton._csr_matrix(symbol).indptr)
+                        for symbol in self.__symbols
+                    ]
+                ).reshape(automaton.states_number, len(self.__symbols))
+                for automaton in (adj_nfa, adj_dfa)
+            )
+        )
+        # blocks of the start nodes in witness_sources (all by default) get
+        # a parent pointer for every product state they reach
+        self.__recorded = None
+        self.__parents = None
+        if record_parents:
+            recorded_states = (
+                self.__start_states_list
+                if witness_sources is None
+                else [
+                    adj_nfa.states_to_num[node]
+                    for node in witness_sources
+                    if node in adj_nfa.states_to_num
                 ]
             )
-            for symbol in self.__united_symbols
-        }
+            self.__recorded = np.isin(self.__start_states_list, recorded_states)
+
+    def __front_edges(self, front_right) -> int:
+        # edges leaving the front in the product: graph edges of every
+        # symbol the DFA state of the row has a transition by
+        nfa_degrees, dfa_degrees = self.__degrees
+        per_row = self.__backend.to_scipy(front_right) @ nfa_degrees
+        dfa_states = np.arange(front_right.shape[0]) % self.__shift
+        return int((np.asarray(per_row) * (dfa_degrees[dfa_states] > 0)).sum())
 
-    def __update_front(self, front_right: Matrix) -> Matrix:
-        def front_mul_matrix(cur_front, symbol) -> Matrix:
-            mul = cur_front @ self.__adj_nfa.adj_matrices[symbol]
-            return self.__permutation_matrices[symbol] @ mul
+    def __pull_front(self, front_right, visited):
+        # every unvisited entry (row, state) looks for a predecessor in the
+        # front: a row of a DFA predecessor of its DFA state in the same
+        # block and a graph predecessor of its state
+        backend = self.__backend
+        shape = front_right.shape
+        front_mask = entries_mask(*backend.nonzero(front_right), shape)
+        visited_rows, visited_cols = backend.nonzero(visited)
+        rows, cols = [], []
+        for symbol in self.__united_symbols:
+            transposed = self.__adj_nfa._transposed_matrix(symbol)
+            unvisited_rows, targets = unvisited_entries(
+                visited_rows, visited_cols, shape, np.diff(transposed.indptr) > 0
+            )
+            blocks, dfa_states = np.divmod(unvisited_rows, self.__shift)
+            owners, previous_states = csr_successors(
+                self.__adj_dfa._transposed_matrix(symbol), dfa_states
+            )
+            hits = pull_hits(
+                transposed,
+                blocks[owners] * self.__shift + previous_states,
+                targets[owners],
+                front_mask,
+                shape[1],
+            )
+            rows.append(unvisited_rows[owners[hits]])
+            cols.append(targets[owners[hits]])
+        return backend.from_coo(np.concatenate(rows), np.concatenate(cols), shape)
 
-        updated_front = reduce(
-            lambda vector, matrix: vector + front_mul_matrix(front_right, matrix),
-            self.__united_symbols,
-            self.__matrix_type(front_right.shape, dtype=bool),
+    def __update_front(self, front_right, visited, visited_entries: int):
+        # the front is a stack of |Q_dfa| x |Q_nfa| blocks, one per start
+        # state; every block is multiplied by the transposed DFA matrix by
+        # moving its rows to the DFA successors instead of building
+        # a block-diagonal copy of the DFA matrix for every start state
+        backend = self.__backend
+        rows_number = front_right.shape[0]
+        if self.__degrees is not None:
+            # one bottom-up candidate per unvisited entry and symbol
+            entries = rows_number * front_right.shape[1]
+            if use_pull(
+                self.__direction,
+                self.__front_edges(front_right),
+                (entries - visited_entries) * len(self.__symbols),
+                entries * len(self.__symbols),
+            ):
+                return self.__pull_front(front_right, visited)
+        moved_fronts = []
+        for symbol in self.__united_symbols:
+            moved = backend.mul(front_right, self.__adj_nfa._csr_matrix(symbol))
+            rows = np.flatnonzero(backend.row_nnz(moved))
+            blocks, dfa_states = np.divmod(rows, self.__shift)
+            owners, next_states = csr_successors(
+                self.__adj_dfa._csr_matrix(symbol), dfa_states
+            )
+            moved_fronts.append(
+                backend.move_rows(
+                    moved,
+                    rows[owners],
+                    blocks[owners] * self.__shift + next_states,
+                    rows_number,
+                )
+            )
+
+        return reduce(backend.add, moved_fronts, backend.zeros(front_right.shape))
+
+    def __get_init_front(self):
+        starts_number = len(self.__start_states_list)
+        dfa_starts = np.fromiter(self.__adj_dfa.start_states, dtype=np.int64)
+        return self.__backend.from_coo(
+            np.add.outer(np.arange(starts_number) * self.__shift, dfa_starts).ravel(),
+            np.repeat(self.__start_states_list, len(dfa_starts)),
+            (starts_number * self.__shift, self.__adj_nfa.states_number),
         )
 
-        return updated_front
+    def __record_parents(
+        self,
+        previous_front,
+        front_right,
+        active: np.ndarray,
+        parents: list,
+    ):
+        # expands the recorded blocks of the previous front edge by edge and
+        # keeps one edge into every newly visited entry; entry (row, state)
+        # is keyed by global_row * |Q_nfa| + state
+        states_number = self.__adj_nfa.states_number
+        local_rows = self.__block_rows(np.arange(len(active)))
+        global_rows = self.__block_rows(active)
+        recorded_rows = np.repeat(self.__recorded[active], self.__shift)
 
-    def __get_init_front(self) -> Matrix:
-        vectors = []
-        for nfa_state_num in range(len(self.__adj_nfa.start_states)):
-            right_vector = self.__matrix_type(
-                (self.__shift, self.__adj_nfa.states_number), dtype=bool
+        previous_rows, previous_cols = self.__backend.nonzero(previous_front)
+        keep = recorded_rows[previous_rows]
+        blocks, dfa_states = np.divmod(
+            local_rows[previous_rows[keep]].astype(np.int64), self.__shift
+        )
+        nfa_states = previous_cols[keep].astype(np.int64)
+        reached_rows, reached_cols = self.__backend.nonzero(front_right)
+        reached_keys = np.sort(
+            global_rows[reached_rows].astype(np.int64) * states_number + reached_cols
+        )
+
+        for symbol_id, symbol in enumerate(self.__symbols):
+            nfa_owners, next_nfa = csr_successors(
+                self.__adj_nfa._csr_matrix(symbol), nfa_states
+            )
+            dfa_owners, next_dfa = csr_successors(
+                self.__adj_dfa._csr_matrix(symbol), dfa_states[nfa_owners]
+            )
+            owners = nfa_owners[dfa_owners]
+            keys = (
+                global_rows[blocks[owners] * self.__shift + next_dfa] * states_number
+                + next_nfa[dfa_owners]
+            )
+            positions = np.searchsorted(reached_keys, keys)
+            is_new = positions < len(reached_keys)
+            is_new[is_new] = reached_keys[positions[is_new]] == keys[is_new]
+            parent_keys = (
+                global_rows[blocks[owners] * self.__shift + dfa_states[owners]]
+                * states_number
+                + nfa_states[owners]
+            )
+            parents.append(
+                (
+                    keys[is_new],
+                    parent_keys[is_new],
+                    np.full(is_new.sum(), symbol_id, dtype=np.int32),
+                )
             )
-            for i in self.__adj_dfa.start_states:
-                right_vector[i, self.__start_states_list[nfa_state_num]] = True
 
-            vectors.append(right_vector)
+    def __answer_states(self, visited: sp.csr_matrix) -> tuple[np.ndarray, np.ndarray]:
+        # row start * |Q_dfa| + dfa_state of visited holds the graph states
+        # reached from the start-th start state in dfa_state
+        rows, nfa_states = visited.nonzero()
+        starts, dfa_states = np.divmod(rows, self.__shift)
+        keep = (
+            state_mask(self.__adj_dfa.final_states, self.__shift)[dfa_states]
+            & state_mask(self.__adj_nfa.final_states, self.__adj_nfa.states_number)[
+                nfa_states
+            ]
+        )
+        sources = np.asarray(self.__start_states_list, dtype=np.int64)[starts[keep]]
+        return sources, nfa_states[keep]
 
-        return sp.vstack(vectors)
+    def __block_rows(self, blocks: np.ndarray) -> np.ndarray:
+        return np.add.outer(blocks * self.__shift, np.arange(self.__shift)).ravel()
 
-    def __visited_to_result(self, visited: Matrix):
-        result = set()
-        for left, nfa_state in zip(*visited.nonzero()):
-            if (
-                left % self.__shift in self.__adj_dfa.final_states
-                and nfa_state in self.__adj_nfa.final_states
-            ):
-                result.add(
+    def __ms_bfs(self) -> sp.csr_matrix:
+        # only blocks of start states whose BFS has not converged yet stay in
+        # the front and visited matrices; the visited rows of converged blocks
+        # are moved aside and put back in place at the end
+        backend = self.__backend
+        front_right = self.__get_init_front()
+        visited = front_right
+        visited_entries = backend.nnz(visited)
+        active = np.arange(len(self.__start_states_list))
+        done_rows, done_cols = [], []
+        parents = []
+
+        def retire(blocks, local_blocks):
+            rows, cols = backend.nonzero(
+                backend.rows(visited, self.__block_rows(local_blocks))
+            )
+            done_rows.append(self.__block_rows(blocks)[rows])
+            done_cols.append(cols)
+            return len(rows)
+
+        while backend.nnz(front_right):
+            previous_front = front_right
+            front_right = backend.diff(
+                self.__update_front(front_right, visited, visited_entries), visited
+            )
+            visited = backend.add(visited, front_right)
+            visited_entries += backend.nnz(front_right)
+            if self.__recorded is not None:
+                self.__record_parents(previous_front, front_right, active, parents)
+
+            alive = (
+                backend.row_nnz(front_right).reshape(-1, self.__shift).sum(axis=1) > 0
+            )
+            if not alive.all():
+                visited_entries -= retire(active[~alive], np.flatnonzero(~alive))
+                rows = self.__block_rows(np.flatnonzero(alive))
+                front_right = backend.rows(front_right, rows)
+                visited = backend.rows(visited, rows)
+                active = active[alive]
+        retire(active, np.arange(len(active)))
+
+        if self.__recorded is not None:
+            keys, parent_keys, symbol_ids = (
+                np.concatenate([level[i] for level in parents])
+                if parents
+                else np.empty(0, dtype=np.int64)
+                for i in range(3)
+            )
+            # several edges may lead into the same entry, any one will do
+            keys, first = np.unique(keys, return_index=True)
+            self.__parents = keys, parent_keys[first], symbol_ids[first]
+
+        return bool_matrix(
+            np.concatenate(done_rows),
+            np.concatenate(done_cols),
+            (
+                len(self.__start_states_list) * self.__shift,
+                self.__adj_nfa.states_number,
+            ),
+        )
+
+    def answer_states(self) -> tuple[np.ndarray, np.ndarray]:
+        # answer pairs as graph states, i.e. positions in adj_nfa.num_to_state,
+        # possibly repeated; cheaper to merge across batches than a result
+        return self.__answer_states(self.__ms_bfs())
+
+    def __call__(self, result_format: str = "set") -> RpqResult:
+        return rpq_result(self.__adj_nfa, *self.answer_states(), result_format)
+
+    def witness_path(self, source, target) -> Optional[list[tuple]]:
+        # shortest path from source to target spelling a word of the DFA as
+        # (from, to, label) edges, or None if target is not reached;
+        # requires a previous call with record_parents, and raises
+        # ValueError for a source whose parents were not recorded, i.e.
+        # one that is not a start node or not in witness_sources
+        if self.__parents is None:
+            raise ValueError("Parents were not recorded, use record_parents=True")
+        source_state = self.__adj_nfa.states_to_num.get(source)
+        if source_state not in self.__start_states_list:
+            raise ValueError(f"{source!r} is not a start node of the query")
+        block = self.__start_states_list.index(source_state)
+        if not self.__recorded[block]:
+            raise ValueError(
+                f"Parents were not recorded for {source!r}, add it to witness_sources"
+            )
+        target_state = self.__adj_nfa.states_to_num.get(target)
+        if target_state is None:
+            return None
+        keys, parent_keys, symbol_ids = self.__parents
+        states_number = self.__adj_nfa.states_number
+        nodes = self.__adj_nfa.num_to_state
+        initial = {
+            (block * self.__shift + state) * states_number
+            + self.__start_states_list[block]
+            for state in self.__adj_dfa.start_states
+        }
+
+        def parent(key):
+            position = np.searchsorted(keys, key)
+            if position < len(keys) and keys[position] == key:
+                return int(parent_keys[position]), int(symbol_ids[position])
+            return None
+
+        paths = []
+        for state in self.__adj_dfa.final_states:
+            key = (block * self.__shift + state) * states_number + target_state
+            if key not in initial and parent(key) is None:
+                continue
+            path = []
+            while key not in initial:
+                parent_key, symbol_id = parent(key)
+                path.append(
                     (
-                        self.__adj_nfa.num_to_state[
-                            self.__start_states_list[left // self.__shift]
-                        ],
-                        self.__adj_nfa.num_to_state[nfa_state],
+                        nodes[parent_key % states_number],
+                        nodes[key % states_number],
+                        self.__symbols[symbol_id].value,
                     )
                 )
-        return result
+                key = parent_key
+            paths.append(path[::-1])
+        return min(paths, key=len, default=None)
 
-    def __ms_bfs(self):
-        front_right = self.__get_init_front()
-        visited = copy(front_right)
 
-        while front_right.count_nonzero():
-            front_right = self.__update_front(front_right)
-            front_right = front_right > visited
-            visited += front_right
+# (front + visited) x (bool data + int64 index) for every dense entry
+_BYTES_PER_FRONT_ENTRY = 2 * (1 + 8)
 
-        return self.__visited_to_result(visited)
 
-    def __call__(self) -> set[tuple[int, int]]:
-        return self.__ms_bfs()
+def batch_size_for_budget(
+    adj_dfa: AdjacencyMatrixFA, adj_nfa: AdjacencyMatrixFA, memory_budget: int
+) -> int:
+    # worst case estimate: every start state reaches every product state
+    per_start = adj_dfa.states_number * adj_nfa.states_number * _BYTES_PER_FRONT_ENTRY
+    return max(1, memory_budget // max(per_start, 1))
+
+
+_worker_rpq = None
+
+
+def _init_worker(
+    adj_dfa: AdjacencyMatrixFA,
+    adj_nfa: AdjacencyMatrixFA,
+    backend: BooleanMatrixBackend,
+    direction: str,
+):
+    # automata are sent to every worker once instead of with every batch
+    global _worker_rpq
+    _worker_rpq = (adj_dfa, adj_nfa, backend, direction)
+
+
+def _run_batch(start_states: list[int]) -> tuple[np.ndarray, np.ndarray]:
+    adj_dfa, adj_nfa, backend, direction = _worker_rpq
+    return MsBfsRpq(
+        adj_dfa,
+        adj_nfa,
+        start_states=start_states,
+        backend=backend,
+        direction=direction,
+    ).answer_states()
 
 
 def ms_bfs_based_rpq(
     regex: str,
-    graph: MultiDiGraph,
+    graph: MultiDiGraph | GraphArrays | LabeledGraph,
     start_nodes: set[int],
     final_nodes: set[int],
     matrix_type=sp.csr_matrix,
-) -> set[tuple[int, int]]:
-    regex_dfa = regex_to_dfa(regex)
-    adj_dfa = AdjacencyMatrixFA(regex_dfa, matrix_type)
-    graph_nfa = graph_to_nfa(graph, start_nodes, final_nodes)
-    adj_nfa = AdjacencyMatrixFA(graph_nfa, matrix_type)
+    result_format: str = "set",
+    batch_size: Optional[int] = None,
+    workers: int = 1,
+    memory_budget: Optional[int] = None,
+    backend: Optional[str | BooleanMatrixBackend] = None,
+    record_parents: bool = False,
+    witness_sources: Optional[Iterable] = None,
+    direction: str = "auto",
+) -> RpqResult | tuple[RpqResult, Callable[[Any, Any], Optional[list[tuple]]]]:
+    # with record_parents the answer comes with a witness_path(source,
+    # target) function, see MsBfsRpq.witness_path; parents are only kept
+    # in memory of a single unbatched search; fronts live on backend if
+    # it is given and on the backend of matrix_type otherwise
+    adj_dfa = regex_cache.adjacency(regex, matrix_type)
+    graph_automaton = graph_to_automaton(graph, start_nodes, final_nodes)
+    backend = backend_for_matrix_type(matrix_type, backend)
+
+    if batch_size is None and memory_budget is None and workers == 1:
+        rpq = MsBfsRpq(
+            adj_dfa,
+            graph_automaton,
+            record_parents=record_parents,
+            witness_sources=witness_sources,
+            backend=backend,
+            direction=direction,
+        )
+        answer = rpq(result_format)
+        return (answer, rpq.witness_path) if record_parents else answer
+    if record_parents:
+        raise ValueError(
+            "Parents can not be recorded with batch_size, memory_budget or workers"
+        )
+
+    adj_nfa = AdjacencyMatrixFA(graph_automaton)
+    start_states = sorted(adj_nfa.start_states)
+    if batch_size is None:
+        batch_size = (
+            batch_size_for_budget(adj_dfa, adj_nfa, memory_budget)
+            if memory_budget is not None
+            else -(-len(start_states) // workers)
+        )
+    if batch_size < 1:
+        raise ValueError(f"Batch size must be positive, got {batch_size}")
+    batches = [
+        start_states[i : i + batch_size]
+        for i in range(0, len(start_states), batch_size)
+    ]
+
+    if workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(adj_dfa, adj_nfa, backend, direction),
+        ) as executor:
+            answers = list(executor.map(_run_batch, batches))
+    else:
+        answers = [
+            MsBfsRpq(
+                adj_dfa,
+                adj_nfa,
+                start_states=batch,
+                backend=backend,
+                direction=direction,
+            ).answer_states()
+            for batch in batches
+        ]
+
+    return rpq_result(
+        adj_nfa,
+        np.concatenate([sources for sources, _ in answers]),
+        np.concatenate([targets for _, targets in answers]),
+        result_format,
+    )
+
+
+def _product_step(
+    adj_dfa: AdjacencyMatrixFA,
+    graph: LabeledGraph,
+    keys: np.ndarray,
+    backward: bool,
+) -> list[tuple[Symbol, np.ndarray, np.ndarray]]:
+    # (symbol, from, to) for the product edges leaving keys, product state
+    # (graph_state, dfa_state) being keyed by graph_state * |Q_dfa| + dfa_state;
+    # the backward search walks the reversed edges
+    shift = adj_dfa.states_number
+    graph_states, dfa_states = np.divmod(keys, shift)
+    graph_matrices = graph.transposed_matrices if backward else graph.matrices
+    steps = []
+    for symbol in adj_dfa.adj_matrices:
+        graph_matrix = graph_matrices.get(symbol.value)
+        if graph_matrix is None:
+            continue
+        if backward:
+            dfa_matrix = adj_dfa._transposed_matrix(symbol)
+        else:
+            dfa_matrix = adj_dfa._csr_matrix(symbol)
+        graph_owners, next_graph = csr_successors(graph_matrix, graph_states)
+        dfa_owners, next_dfa = csr_successors(dfa_matrix, dfa_states[graph_owners])
+        owners = graph_owners[dfa_owners]
+        steps.append((symbol, keys[owners], next_graph[dfa_owners] * shift + next_dfa))
+    return steps
+
+
+def _witness_path(
+    graph: LabeledGraph,
+    shift: int,
+    forward: dict,
+    backward: dict,
+    meeting: int,
+) -> list[tuple]:
+    nodes = graph.nodes
+
+    def edge(key_from, symbol, key_to):
+        return nodes[key_from // shift], nodes[key_to // shift], symbol.value
+
+    path = []
+    key = meeting
+    while forward[key] is not None:
+        parent, symbol = forward[key]
+        path.append(edge(parent, symbol, key))
+        key = parent
+    path.reverse()
+    key = meeting
+    while backward[key] is not None:
+        child, symbol = backward[key]
+        path.append(edge(key, symbol, child))
+        key = child
+    return path
+
+
+def rpq_reachable(
+    regex: str,
+    graph: MultiDiGraph | GraphArrays | LabeledGraph,
+    u,
+    v,
+    return_path: bool = False,
+) -> bool | Optional[list[tuple]]:
+    # bidirectional BFS over the product of the graph and the regex DFA:
+    # forward from (u, DFA start), backward from (v, DFA finals); the side
+    # with the smaller front is expanded until the searches meet.
+    # With return_path the answer is a list of (from, to, label) edges
+    # spelling a word of the regex, or None when v is not reachable.
+    # Only the regex side is compiled per call, the graph matrices and
+    # their transposes are read from the (cached) LabeledGraph
+    adj_dfa = regex_cache.adjacency(regex, sp.csr_matrix)
+    graph = as_labeled_graph(graph)
+    source = graph.node_to_index.get(u)
+    target = graph.node_to_index.get(v)
+    if source is None or target is None:
+        return None if return_path else False
+    shift = adj_dfa.states_number
 
-    result = MsBfsRpq(adj_dfa, adj_nfa, matrix_type)()
+    # visited states of both searches, mapped to the (state, symbol) they
+    # were reached through
+    searches = [
+        {source * shift + state: None for state in adj_dfa.start_states},
+        {target * shift + state: None for state in adj_dfa.final_states},
+    ]
+    fronts = [np.fromiter(search, dtype=np.int64) for search in searches]
 
-    return result
+    meeting = next((key for key in searches[0] if key in searches[1]), None)
+    while meeting is None and len(fronts[0]) and len(fronts[1]):
+        side = 0 if len(fronts[0]) <= len(fronts[1]) else 1
+        visited, other = searches[side], searches[1 - side]
+        reached = []
+        for symbol, sources, targets in _product_step(
+            adj_dfa, graph, fronts[side], side == 1
+        ):
+            for key_from, key_to in zip(sources.tolist(), targets.tolist()):
+                if key_to not in visited:
+                    visited[key_to] = (key_from, symbol)
+                    reached.append(key_to)
+                    if meeting is None and key_to in other:
+                        meeting = key_to
+        fronts[side] = np.asarray(reached, dtype=np.int64)
+
+    if not return_path:
+        return meeting is not None
+    if meeting is None:
+        return None
+    return _witness_path(graph, shift, searches[0], searches[1], meeting)
+
+
+class IncrementalRpq:
+    # answers of a regex query from a fixed set of start nodes, maintained
+    # under edge insertions and deletions; the state is the set of reached
+    # product states (source, dfa_state, node), indexed by node. As in
+    # ms_bfs_based_rpq, missing or empty start and final sets mean all
+    # nodes, including the ones added later with an edge; start nodes not
+    # in the graph yet are only seeded once an edge brings them in
+    __delta: dict[Any, dict[int, list[int]]]
+    __reverse_delta: dict[Any, dict[int, list[int]]]
+    __successors: dict[Any, dict[Any, set]]
+    __predecessors: dict[Any, dict[Any, set]]
+    __edges: Counter
+    __reached: set[tuple[Any, int, Any]]
+    __at_node: defaultdict[Any, set[tuple[Any, int]]]
+    __nodes: set
+    __all_starts: bool
+
+    def __init__(
+        self,
+        regex: str,
+        graph: MultiDiGraph | GraphArrays | LabeledGraph,
+        start_nodes: Optional[Iterable] = None,
+        final_nodes: Optional[Iterable] = None,
+    ):
+        adj_dfa = regex_cache.adjacency(regex, sp.csr_matrix)
+        self.__delta = defaultdict(lambda: defaultdict(list))
+        self.__reverse_delta = defaultdict(lambda: defaultdict(list))
+        for symbol, matrix in adj_dfa.adj_matrices.items():
+            for q_from, q_to in zip(*(a.tolist() for a in matrix.nonzero())):
+                self.__delta[symbol.value][q_from].append(q_to)
+                self.__reverse_delta[symbol.value][q_to].append(q_from)
+        self.__dfa_starts = set(adj_dfa.start_states)
+        self.__dfa_finals = set(adj_dfa.final_states)
+
+        self.__successors = defaultdict(lambda: defaultdict(set))
+        self.__predecessors = defaultdict(lambda: defaultdict(set))
+        self.__edges = Counter()
+        for u, v, label in graph_edges(graph):
+            self.__insert(u, v, label)
+
+        self.__nodes = set(graph_nodes(graph))
+        self.__all_starts = not start_nodes
+        self.__start_nodes = set(self.__nodes if not start_nodes else start_nodes)
+        self.__final_nodes = None if not final_nodes else set(final_nodes)
+        self.__reached = set()
+        self.__at_node = defaultdict(set)
+        self.__propagate(self.__start_states(self.__start_nodes & self.__nodes))
+
+    def __start_states(self, sources: Iterable) -> Iterable[tuple[Any, int, Any]]:
+        return ((source, q, source) for source in sources for q in self.__dfa_starts)
+
+    def __insert(self, u, v, label) -> bool:
+        self.__edges[(u, v, label)] += 1
+        if self.__edges[(u, v, label)] > 1:
+            return False
+        self.__successors[label][u].add(v)
+        self.__predecessors[label][v].add(u)
+        return True
+
+    def __add_state(self, state: tuple[Any, int, Any]):
+        source, q, node = state
+        self.__reached.add(state)
+        self.__at_node[node].add((source, q))
+
+    def __discard_state(self, state: tuple[Any, int, Any]):
+        source, q, node = state
+        self.__reached.discard(state)
+        self.__at_node[node].discard((source, q))
+
+    def __next_states(self, state: tuple[Any, int, Any]) -> Iterable:
+        source, q, node = state
+        for label, delta in self.__delta.items():
+            for q_next in delta.get(q, ()):
+                for node_next in self.__successors[label].get(node, ()):
+                    yield source, q_next, node_next
+
+    def __propagate(self, seeds: Iterable[tuple[Any, int, Any]]):
+        stack = [state for state in seeds if state not in self.__reached]
+        for state in stack:
+            self.__add_state(state)
+        while stack:
+            for state in self.__next_states(stack.pop()):
+                if state not in self.__reached:
+                    self.__add_state(state)
+                    stack.append(state)
+
+    def __has_support(self, state: tuple[Any, int, Any]) -> bool:
+        # whether some reached state still has an edge into state
+        source, q, node = state
+        if node == source and q in self.__dfa_starts:
+            return True
+        for label, reverse_delta in self.__reverse_delta.items():
+            for q_prev in reverse_delta.get(q, ()):
+                for node_prev in self.__predecessors[label].get(node, ()):
+                    if (source, q_prev, node_prev) in self.__reached:
+                        return True
+        return False
+
+    def add_edge(self, u, v, label):
+        if not self.__insert(u, v, label):
+            return
+        new_nodes = {u, v} - self.__nodes
+        self.__nodes.update(new_nodes)
+        if self.__all_starts:
+            self.__start_nodes.update(new_nodes)
+        self.__propagate(self.__start_states(new_nodes & self.__start_nodes))
+        self.__propagate(
+            (source, q_next, v)
+            for source, q in list(self.__at_node.get(u, ()))
+            for q_next in self.__delta.get(label, {}).get(q, ())
+        )
+
+    def remove_edge(self, u, v, label):
+        if not self.__edges[(u, v, label)]:
+            raise KeyError(f"No edge {(u, v, label)!r} in the graph")
+        self.__edges[(u, v, label)] -= 1
+        if self.__edges[(u, v, label)]:
+            return
+        del self.__edges[(u, v, label)]
+        self.__successors[label][u].discard(v)
+        self.__predecessors[label][v].discard(u)
+
+        # delete everything the edge may have been needed for, then put back
+        # the states that still have an edge from a state outside the region
+        region = set()
+        stack = [
+            (source, q_next, v)
+            for source, q in self.__at_node.get(u, ())
+            for q_next in self.__delta.get(label, {}).get(q, ())
+            if (source, q_next, v) in self.__reached
+        ]
+        region.update(stack)
+        while stack:
+            for state in self.__next_states(stack.pop()):
+                if state in self.__reached and state not in region:
+                    region.add(state)
+                    stack.append(state)
+        for state in region:
+            self.__discard_state(state)
+        self.__propagate([state for state in region if self.__has_support(state)])
+
+    def result(self) -> set[tuple]:
+        return {
+            (source, node)
+            for source, q, node in self.__reached
+            if q in self.__dfa_finals
+            and (self.__final_nodes is None or node in self.__final_nodes)
+        }
@@ -1,9 +1,41 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import pathlib
+import tempfile
+from collections import OrderedDict, defaultdict, deque
+from dataclasses import dataclass
+from typing import Any, Optional
 import networkx as nx
+import numpy as np
 import pyformlang
 from pyformlang.cfg import Production, Variable, Epsilon, CFG, Terminal
 
+from project.task1 import GraphArrays, LabeledGraph, as_labeled_graph
 
-def cfg_to_weak_normal_form(cfg: pyformlang.cfg.CFG) -> pyformlang.cfg.CFG:
+
+# normal forms are only stored on disk when a directory is configured,
+# e.g. ~/.cache/formal-lang-course/wcnf
+WCNF_CACHE_DIR = (
+    pathlib.Path(os.environ["WCNF_CACHE_DIR"]) if os.getenv("WCNF_CACHE_DIR") else None
+)
+
+# bump when the conversion changes so that stale files on disk are not used
+_WCNF_FORMAT_VERSION = 1
+
+
+def _pyformlang_version() -> str:
+    try:
+        return importlib.metadata.version("pyformlang")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+_PYFORMLANG_VERSION = _pyformlang_version()
+
+
+def _to_weak_normal_form(cfg: pyformlang.cfg.CFG) -> pyformlang.cfg.CFG:
     modified_productions = set(cfg.to_normal_form().productions)
     for null_var in cfg.get_nullable_symbols():
         modified_productions.add(Production(Variable(null_var.value), [Epsilon()]))
@@ -13,59 +45,319 @@ def cfg_to_weak_normal_form(cfg: pyformlang.cfg.CFG) -> pyformlang.cfg.CFG:
     ).remove_useless_symbols()
 
 
+def _symbol_kind(symbol) -> str:
+    return "v" if isinstance(symbol, Variable) else "t"
+
+
+def _dump_cfg(cfg: pyformlang.cfg.CFG) -> dict:
+    # epsilon bodies are stored as empty lists, as Production drops Epsilon
+    return {
+        "start": cfg.start_symbol.value,
+        "productions": [
+            [prod.head.value, [[_symbol_kind(sym), sym.value] for sym in prod.body]]
+            for prod in cfg.productions
+        ],
+    }
+
+
+def _load_cfg(data: dict) -> pyformlang.cfg.CFG:
+    return CFG(
+        start_symbol=Variable(data["start"]),
+        productions={
+            Production(
+                Variable(head),
+                [
+                    Variable(value) if kind == "v" else Terminal(value)
+                    for kind, value in body
+                ],
+            )
+            for head, body in data["productions"]
+        },
+    )
+
+
+def _is_json_value(value) -> bool:
+    return isinstance(value, str | int) and not isinstance(value, bool)
+
+
+class WcnfCache:
+    # weak normal forms keyed by a hash of the grammar's productions and the
+    # pyformlang version, kept in an LRU in memory and, if store_dir or
+    # WCNF_CACHE_DIR is set, as json files there; grammars whose symbols
+    # are not strings or ints are only cached in memory, as json would not
+    # give the same values back
+    _maxsize: int
+    _store_dir: Optional[pathlib.Path]
+    _entries: OrderedDict[str, dict]
+    hits: int
+    misses: int
+
+    def __init__(self, maxsize: int = 32, store_dir: str | pathlib.Path = None):
+        self._maxsize = maxsize
+        self._store_dir = pathlib.Path(store_dir) if store_dir is not None else None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def store_dir(self) -> Optional[pathlib.Path]:
+        return self._store_dir or WCNF_CACHE_DIR
+
+    @staticmethod
+    def key(cfg: pyformlang.cfg.CFG) -> str:
+        productions = sorted(
+            repr(
+                (
+                    prod.head.value,
+                    [(_symbol_kind(sym), sym.value) for sym in prod.body],
+                )
+            )
+            for prod in cfg.productions
+        )
+        text = "\n".join(
+            [
+                str(_WCNF_FORMAT_VERSION),
+                _PYFORMLANG_VERSION,
+                repr(cfg.start_symbol.value),
+                *productions,
+            ]
+        )
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def clear(self):
+        self._entries.clear()
+
+    def __entry(self, cfg: pyformlang.cfg.CFG) -> dict:
+        key = self.key(cfg)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        wcnf_cfg = self.__load(key)
+        if wcnf_cfg is None:
+            self.misses += 1
+            wcnf_cfg = _to_weak_normal_form(cfg)
+            self.__save(key, wcnf_cfg)
+        else:
+            self.hits += 1
+        entry = {"wcnf": wcnf_cfg, "interned": None}
+        self._entries[key] = entry
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def __load(self, key: str) -> Optional[pyformlang.cfg.CFG]:
+        if self.store_dir is None:
+            return None
+        path = self.store_dir / f"{key}.json"
+        try:
+            with open(path) as f:
+                return _load_cfg(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def __save(self, key: str, wcnf_cfg: pyformlang.cfg.CFG):
+        if self.store_dir is None:
+            return
+        data = _dump_cfg(wcnf_cfg)
+        values = [data["start"]] + [
+            value
+            for head, body in data["productions"]
+            for value in [head, *(value for _, value in body)]
+        ]
+        if not all(_is_json_value(value) for value in values):
+            return
+        try:
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            # write into a temporary file first so that a half-written
+            # grammar is never picked up by __load
+            fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(tmp_path, self.store_dir / f"{key}.json")
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        except OSError:
+            # the disk cache is an optimization only
+            pass
+
+    def weak_normal_form(self, cfg: pyformlang.cfg.CFG) -> pyformlang.cfg.CFG:
+        return self.__entry(cfg)["wcnf"]
+
+    def interned(self, cfg: pyformlang.cfg.CFG) -> "InternedGrammar":
+        entry = self.__entry(cfg)
+        if entry["interned"] is None:
+            entry["interned"] = _intern_weak_normal_form(entry["wcnf"])
+        return entry["interned"]
+
+
+wcnf_cache = WcnfCache()
+
+
+def cfg_to_weak_normal_form(cfg: pyformlang.cfg.CFG) -> pyformlang.cfg.CFG:
+    return wcnf_cache.weak_normal_form(cfg)
+
+
+@dataclass(frozen=True)
+class InternedGrammar:
+    # weak normal form grammar with variables numbered densely, built once
+    # and reusable across queries; terminal rules are keyed by the terminal
+    # value, i.e. by graph label, and dependents[var] lists the binary rules
+    # with var in the body
+    variables: list[Variable]
+    start: int
+    terminal_heads: dict[Any, list[int]]
+    binary: list[tuple[int, int, int]]
+    nullable: list[int]
+    dependents: list[list[int]]
+
+    @property
+    def variables_number(self) -> int:
+        return len(self.variables)
+
+
+def intern_grammar(cfg: pyformlang.cfg.CFG | InternedGrammar) -> InternedGrammar:
+    if isinstance(cfg, InternedGrammar):
+        return cfg
+    return wcnf_cache.interned(cfg)
+
+
+def _intern_weak_normal_form(wcnf_cfg: pyformlang.cfg.CFG) -> InternedGrammar:
+    variables = sorted(wcnf_cfg.variables, key=lambda var: str(var.value))
+    start_var = Variable(wcnf_cfg.start_symbol.value)
+    if start_var not in variables:
+        variables.append(start_var)
+    index = {var: idx for idx, var in enumerate(variables)}
+
+    terminal_heads = defaultdict(list)
+    binary = []
+    for prod in wcnf_cfg.productions:
+        if len(prod.body) == 1 and isinstance(prod.body[0], Terminal):
+            terminal_heads[prod.body[0].value].append(index[prod.head])
+        elif len(prod.body) == 2:
+            binary.append(
+                (
+                    index[prod.head],
+                    index[Variable(prod.body[0].value)],
+                    index[Variable(prod.body[1].value)],
+                )
+            )
+    nullable = [index[Variable(var.value)] for var in wcnf_cfg.get_nullable_symbols()]
+    dependents = [[] for _ in variables]
+    for rule, (_, b, c) in enumerate(binary):
+        dependents[b].append(rule)
+        if c != b:
+            dependents[c].append(rule)
+    return InternedGrammar(
+        variables, index[start_var], dict(terminal_heads), binary, nullable, dependents
+    )
+
+
+def terminal_facts(
+    grammar: InternedGrammar, graph: LabeledGraph
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (variable, u, v) arrays of the facts given by terminal and epsilon rules
+    variables, sources, targets = [], [], []
+    for label, matrix in graph.matrices.items():
+        rows, cols = matrix.nonzero()
+        for head in grammar.terminal_heads.get(label, ()):
+            variables.append(np.full(len(rows), head, dtype=np.int64))
+            sources.append(rows.astype(np.int64))
+            targets.append(cols.astype(np.int64))
+    diagonal = np.arange(graph.number_of_nodes, dtype=np.int64)
+    for var in grammar.nullable:
+        variables.append(np.full(len(diagonal), var, dtype=np.int64))
+        sources.append(diagonal)
+        targets.append(diagonal)
+    if not variables:
+        return (np.empty(0, dtype=np.int64),) * 3
+    return np.concatenate(variables), np.concatenate(sources), np.concatenate(targets)
+
+
+def select_pairs(
+    graph: LabeledGraph,
+    sources: np.ndarray,
+    targets: np.ndarray,
+    start_nodes: Optional[set] = None,
+    final_nodes: Optional[set] = None,
+) -> set[tuple]:
+    # node pairs of the given node indices, a missing node set meaning
+    # all nodes
+    keep = np.ones(len(sources), dtype=bool)
+    for nodes, indices in ((start_nodes, sources), (final_nodes, targets)):
+        if nodes is not None:
+            mask = np.zeros(graph.number_of_nodes, dtype=bool)
+            mask[graph.indices(nodes)] = True
+            keep &= mask[indices]
+    index_to_node = np.fromiter(graph.nodes, dtype=object, count=graph.number_of_nodes)
+    return set(
+        zip(
+            index_to_node[sources[keep]].tolist(),
+            index_to_node[targets[keep]].tolist(),
+        )
+    )
+
+
 def hellings_based_cfpq(
-    cfg: pyformlang.cfg.CFG,
-    graph: nx.DiGraph,
+    cfg: pyformlang.cfg.CFG | InternedGrammar,
+    graph: nx.DiGraph | GraphArrays | LabeledGraph,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
 ) -> set[tuple[int, int]]:
-    wcnf_cfg = cfg_to_weak_normal_form(cfg)
+    grammar = intern_grammar(cfg)
+    graph = as_labeled_graph(graph)
+    n = graph.number_of_nodes
+    vars_number = grammar.variables_number
 
-    term_to_vars = {}
-    pair_to_vars = {}
+    # partners of a variable in binary bodies: A -> (B, heads of A B)
+    right_partners = defaultdict(lambda: defaultdict(list))
+    left_partners = defaultdict(lambda: defaultdict(list))
+    for head, b, c in grammar.binary:
+        right_partners[b][c].append(head)
+        left_partners[c][b].append(head)
+    right_partners = {a: list(p.items()) for a, p in right_partners.items()}
+    left_partners = {a: list(p.items()) for a, p in left_partners.items()}
 
-    for prod in wcnf_cfg.productions:
-        if len(prod.body) == 1 and isinstance(prod.body[0], Terminal):
-            term_to_vars.setdefault(prod.body[0], set()).add(prod.head)
-        elif len(prod.body) == 2:
-            pair_to_vars.setdefault(tuple(prod.body), set()).add(prod.head)
+    # fact (u, var, v) is the int (var * n + u) * n + v; facts are indexed
+    # by (node, variable): outgoing[u * |V| + var] holds every v of a fact
+    # (u, var, v), incoming[v * |V| + var] every u
+    variables, sources, targets = terminal_facts(grammar, graph)
+    facts = set(((variables * n + sources) * n + targets).tolist())
+    outgoing = defaultdict(set)
+    incoming = defaultdict(set)
+    for var, u, v in zip(variables.tolist(), sources.tolist(), targets.tolist()):
+        outgoing[u * vars_number + var].add(v)
+        incoming[v * vars_number + var].add(u)
 
-    graph_edges = {
-        (v1, Terminal(label), v2) for v1, v2, label in graph.edges.data("label")
-    }
+    queue = deque(facts)
 
-    new_edges = {
-        (v1, var, v2)
-        for v1, term, v2 in graph_edges
-        if term in term_to_vars
-        for var in term_to_vars[term]
-    } | {(v, var, v) for v in graph.nodes for var in wcnf_cfg.get_nullable_symbols()}
-
-    queue = list(new_edges)
-
-    def update_queue(e1, e2, buff):
-        s1, a, f1 = e1
-        s2, b, f2 = e2
-        if f1 == s2:
-            pair = (a, b)
-            if pair in pair_to_vars:
-                for var in pair_to_vars[pair]:
-                    new_edge = (s1, var, f2)
-                    if new_edge not in new_edges:
-                        buff.add(new_edge)
-                        queue.append(new_edge)
+    def add_fact(var, u, v):
+        key = (var * n + u) * n + v
+        if key not in facts:
+            facts.add(key)
+            outgoing[u * vars_number + var].add(v)
+            incoming[v * vars_number + var].add(u)
+            queue.append(key)
 
     while queue:
-        edge = queue.pop(0)
-        buffer = set()
-        for e in new_edges:
-            update_queue(edge, e, buffer)
-            update_queue(e, edge, buffer)
-        new_edges |= buffer
-
-    start_var = wcnf_cfg.start_symbol
-    return {
-        (v1, v2)
-        for v1, var, v2 in new_edges
-        if v1 in start_nodes and var == start_var and v2 in final_nodes
-    }
+        a_s, f = divmod(queue.popleft(), n)
+        a, s = divmod(a_s, n)
+        # (s, a, f) (f, b, g) -> (s, head, g)
+        for b, heads in right_partners.get(a, ()):
+            for g in list(outgoing.get(f * vars_number + b, ())):
+                for head in heads:
+                    add_fact(head, s, g)
+        # (r, b, s) (s, a, f) -> (r, head, f)
+        for b, heads in left_partners.get(a, ()):
+            for r in list(incoming.get(s * vars_number + b, ())):
+                for head in heads:
+                    add_fact(head, r, f)
+
+    keys = np.fromiter(facts, dtype=np.int64, count=len(facts))
+    start_var_keys = keys[keys // (n * n) == grammar.start] if n else keys
+    sources, targets = np.divmod(start_var_keys % max(n * n, 1), max(n, 1))
+    return select_pairs(graph, sources, targets, start_nodes, final_nodes)
@@ -1,83 +1,99 @@
+from collections import deque
 from typing import Any, Set, Tuple
 import networkx as nx
-from pyformlang.cfg import CFG, Terminal, Variable
-from scipy.sparse import csr_matrix
-from project.task6 import cfg_to_weak_normal_form
+import numpy as np
+from pyformlang.cfg import CFG
+from project.backends import BooleanMatrixBackend, get_backend
+from project.task1 import GraphArrays, LabeledGraph, as_labeled_graph
+from project.task6 import (
+    InternedGrammar,
+    intern_grammar,
+    select_pairs,
+    terminal_facts,
+)
 
 
 def matrix_based_cfpq(
-    cfg: CFG,
-    graph: nx.DiGraph,
+    cfg: CFG | InternedGrammar,
+    graph: nx.DiGraph | GraphArrays | LabeledGraph,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    backend: str | BooleanMatrixBackend = "scipy",
 ) -> Set[Tuple[int, int]]:
-    wnf: CFG = cfg_to_weak_normal_form(cfg)
-    nodes_amount: int = graph.number_of_nodes()
-    node_to_index: dict[Any, int] = {
-        node: idx for idx, node in enumerate(graph.nodes())
-    }
-    index_to_node: dict[int, Any] = {idx: node for node, idx in node_to_index.items()}
+    backend = get_backend(backend)
+    grammar = intern_grammar(cfg)
+    graph: LabeledGraph = as_labeled_graph(graph)
+    nodes_amount: int = graph.number_of_nodes
+    shape = (nodes_amount, nodes_amount)
 
-    var_mats: dict[Variable, csr_matrix] = {}
-    for u, v, data in graph.edges(data=True):
-        label = data.get("label")
-        if label:
-            for p in wnf.productions:
-                if len(p.body) == 1 and isinstance(p.body[0], Terminal):
-                    terminal = p.body[0].value
-                    if terminal == label:
-                        head = p.head
-                        if head not in var_mats:
-                            var_mats[head] = csr_matrix(
-                                (nodes_amount, nodes_amount), dtype=bool
-                            )
-                        var_mats[head][node_to_index[u], node_to_index[v]] = True
+    # Переменные занумерованы, матрица переменной с номером i лежит в var_mats[i].
+    # Матрицы терминальных правил A -> a и диагонали nullable символов
+    # собираются из троек (A, u, v), сгруппированных по переменной
+    variables, sources, targets = terminal_facts(grammar, graph)
+    order = np.argsort(variables, kind="stable")
+    bounds = np.searchsorted(variables[order], np.arange(grammar.variables_number + 1))
+    sources, targets = sources[order], targets[order]
+    var_mats: list[Any] = [
+        backend.from_coo(
+            sources[bounds[var] : bounds[var + 1]],
+            targets[bounds[var] : bounds[var + 1]],
+            shape,
+        )
+        for var in range(grammar.variables_number)
+    ]
 
-    # Учитываем nullable символы для диагональных элементов
-    nullable = wnf.get_nullable_symbols()
-    for node in graph.nodes:
-        for var in nullable:
-            var = Variable(var.value)
-            if var not in var_mats:
-                var_mats[var] = csr_matrix((nodes_amount, nodes_amount), dtype=bool)
-            var_mats[var][node_to_index[node], node_to_index[node]] = True
+    # Полунаивная итерация: в delta_mats[i] лежат пары переменной i, ещё не
+    # соединённые с парами других переменных. Новые пары правила A -> B C
+    # получаются только из ΔB @ C или B @ ΔC, поэтому правила с пустой
+    # дельтой не пересчитываются. Дельты разбираются по одной переменной,
+    # и найденные пары сразу добавляются в матрицы, так что следующие
+    # переменные видят их в том же проходе
+    # Очередь pending дублируется множеством queued для проверки за O(1)
+    delta_mats: list[Any] = list(var_mats)
+    pending = deque(
+        var for var in range(grammar.variables_number) if backend.nnz(var_mats[var])
+    )
+    queued = set(pending)
+    empty = backend.zeros(shape)
+    while pending:
+        var = pending.popleft()
+        queued.discard(var)
+        delta = delta_mats[var]
+        delta_mats[var] = empty
+        # Произведения всех правил с var в теле складываются по голове правила
+        new_mats: dict[int, Any] = {}
+        for head, b, c in (grammar.binary[rule] for rule in grammar.dependents[var]):
+            products = []
+            if b == var:
+                products.append(backend.mul(delta, var_mats[c]))
+            if c == var:
+                products.append(backend.mul(var_mats[b], delta))
+            for product in products:
+                new_mats[head] = (
+                    backend.add(new_mats[head], product)
+                    if head in new_mats
+                    else product
+                )
 
-    # Обработка правил вида A -> B C с добавлением новых достижимых пар
-    added = True
-    while added:
-        added = False
-        for p in wnf.productions:
-            if len(p.body) == 2:
-                B = Variable(p.body[0].value)
-                C = Variable(p.body[1].value)
-                head = p.head
-                if B in var_mats and C in var_mats:
-                    if head not in var_mats:
-                        var_mats[head] = csr_matrix(
-                            (nodes_amount, nodes_amount), dtype=bool
-                        )
-
-                    new_mat = var_mats[B] @ var_mats[C]
-                    new_mat_coo = new_mat.tocoo()
-
-                    for u, v, value in zip(
-                        new_mat_coo.row, new_mat_coo.col, new_mat_coo.data
-                    ):
-                        if value and not var_mats[head][u, v]:
-                            var_mats[head][u, v] = True
-                            added = True
+        # Оставляем только действительно новые пары и добавляем их разом
+        for head, new_mat in new_mats.items():
+            new_mat = backend.diff(new_mat, var_mats[head])
+            if not backend.nnz(new_mat):
+                continue
+            var_mats[head] = backend.add(var_mats[head], new_mat)
+            if head not in queued:
+                delta_mats[head] = new_mat
+                pending.append(head)
+                queued.add(head)
+            else:
+                delta_mats[head] = backend.add(delta_mats[head], new_mat)
 
     # Формируем множество достижимых пар для символа стартовой грамматики
-    pairs = set()
-    start_symbol = wnf.start_symbol
-    if start_symbol in var_mats:
-        final_mat = var_mats[start_symbol].tocoo()
-        for u_idx, v_idx in zip(final_mat.row, final_mat.col):
-            u = index_to_node[u_idx]
-            v = index_to_node[v_idx]
-            if (not start_nodes or u in start_nodes) and (
-                not final_nodes or v in final_nodes
-            ):
-                pairs.add((u, v))
-
-    return pairs
+    rows, cols = backend.nonzero(var_mats[grammar.start])
+    return select_pairs(
+        graph,
+        np.asarray(rows, dtype=np.int64),
+        np.asarray(cols, dtype=np.int64),
+        start_nodes or None,
+        final_nodes or None,
+    )
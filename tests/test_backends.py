@@ -0,0 +1,56 @@
+import cfpq_data as cd
+import pytest
+from pyformlang.cfg import CFG
+import scipy.sparse as sp
+from project.backends import BACKENDS, backend_for_matrix_type, get_backend
+from project.bitmatrix import BitMatrix
+from project.task1 import LabeledGraph
+from project.task3 import tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
+from project.task7 import matrix_based_cfpq
+
+graph = LabeledGraph.from_networkx(cd.labeled_two_cycles_graph(4, 3, labels=("a", "b")))
+start, final = {0, 1, 5}, {0, 2, 3, 6}
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+@pytest.mark.parametrize("regex", ["a*", "a b", "(a|b)* b"])
+def test_rpq_backends(backend, regex):
+    expected = tensor_based_rpq(regex, graph, start, final)
+
+    assert tensor_based_rpq(regex, graph, start, final, backend=backend) == expected
+    assert ms_bfs_based_rpq(regex, graph, start, final, backend=backend) == expected
+
+
+@pytest.mark.parametrize("backend", sorted(BACKENDS))
+def test_cfpq_backends(backend):
+    cfg = CFG.from_text("S -> a S b | a b | $")
+
+    expected = matrix_based_cfpq(cfg, graph)
+
+    assert matrix_based_cfpq(cfg, graph, backend=backend) == expected
+
+
+def test_backend_wins_over_matrix_type():
+    assert backend_for_matrix_type(BitMatrix).name == "bitset"
+    assert backend_for_matrix_type(sp.csr_matrix).name == "scipy"
+    assert backend_for_matrix_type(BitMatrix, "dense").name == "dense"
+    assert backend_for_matrix_type(sp.csr_matrix, "bitset").name == "bitset"
+
+    expected = ms_bfs_based_rpq("(a|b)* b", graph, start, final)
+    for backend in sorted(BACKENDS):
+        assert (
+            ms_bfs_based_rpq(
+                "(a|b)* b", graph, start, final, BitMatrix, backend=backend
+            )
+            == expected
+        )
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend("gpu")
+    with pytest.raises(ValueError):
+        tensor_based_rpq(
+            "a", graph, start, final, closure_strategy="scc", backend="dense"
+        )
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from project.bitmatrix import BitMatrix
+
+rng = np.random.default_rng(7)
+left = sp.random(9, 70, density=0.2, format="csr", random_state=rng) > 0
+right = sp.random(70, 130, density=0.05, format="csr", random_state=rng) > 0
+
+
+def test_round_trip():
+    bits = BitMatrix(left)
+
+    assert bits.shape == left.shape
+    assert bits.nnz == left.nnz
+    assert (bits.toarray() == left.toarray()).all()
+    assert (bits.tocsr() != left).nnz == 0
+    assert (bits.getnnz(axis=1) == left.getnnz(axis=1)).all()
+    assert (BitMatrix(left.toarray()).toarray() == left.toarray()).all()
+    assert (bits.T.toarray() == left.T.toarray()).all()
+
+
+@pytest.mark.parametrize("packed_right", [True, False])
+def test_products(packed_right):
+    other = BitMatrix(right) if packed_right else right
+
+    product = BitMatrix(left) @ other
+
+    assert isinstance(product, BitMatrix)
+    assert (product.toarray() == (left @ right).toarray()).all()
+    assert ((left @ BitMatrix(right)).toarray() == (left @ right).toarray()).all()
+
+
+def test_elementwise():
+    other = sp.random(9, 70, density=0.3, format="csr", random_state=rng) > 0
+    bits = BitMatrix(left)
+
+    assert ((bits + other).toarray() == (left + other).toarray()).all()
+    assert ((bits > other).toarray() == (left > other).toarray()).all()
+    bits += other
+    assert bits.nnz == (left + other).nnz
+    assert (bits[[0, 3]].toarray() == (left + other)[[0, 3]].toarray()).all()
+
+
+def test_sparse_conversions_do_not_unpack(monkeypatch):
+    def fail(self):
+        raise AssertionError("matrix was unpacked to a dense array")
+
+    bits = BitMatrix(left)
+    monkeypatch.setattr(BitMatrix, "toarray", fail)
+
+    assert (bits.tocsr() != left).nnz == 0
+    assert sorted(zip(*bits.nonzero())) == sorted(zip(*left.nonzero()))
+    assert ((bits @ right).tocsr() != left @ right).nnz == 0
+    assert ((right.T @ BitMatrix(right)).tocsr() != right.T @ right).nnz == 0
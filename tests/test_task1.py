@@ -1,5 +1,11 @@
 from pathlib import Path
+import cfpq_data as cd
+import networkx as nx
+import numpy as np
+import pytest
 from project import task1
+from project.task3 import tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
 
 
 class TestGraphUtils:
@@ -24,3 +30,100 @@ class TestGraphUtils:
         assert file_path.is_file()
 
         file_path.unlink()
+
+
+@pytest.fixture
+def csv_graph(tmp_path):
+    path = tmp_path / "graph.csv"
+    path.write_text("0 1 a\n1 2 b\n2 0 a\n2 3 a\n0 1 b\n")
+    return path
+
+
+class TestGraphStore:
+    def test_arrays_match_networkx(self, csv_graph):
+        arrays = task1.graph_arrays_from_csv(csv_graph)
+        graph = cd.graph_from_csv(csv_graph)
+
+        assert arrays.number_of_nodes == graph.number_of_nodes()
+        assert arrays.number_of_edges == graph.number_of_edges()
+        assert arrays.sorted_labels() == cd.get_sorted_labels(graph)
+        assert sorted(arrays.edges()) == sorted(graph.edges(data="label"))
+
+    def test_store_is_reused(self, csv_graph, tmp_path, monkeypatch):
+        monkeypatch.setattr(cd, "download", lambda name: csv_graph)
+        arrays = task1.load_graph_arrays("graph", tmp_path / "store")
+
+        def fail(name):
+            raise AssertionError("graph must be loaded from the store")
+
+        monkeypatch.setattr(cd, "download", fail)
+        cached = task1.load_graph_arrays("graph", tmp_path / "store")
+
+        assert isinstance(cached.src, np.memmap)
+        assert list(cached.edges()) == list(arrays.edges())
+        assert cached.labels == arrays.labels
+
+    def test_store_is_versioned(self, csv_graph, tmp_path, monkeypatch):
+        monkeypatch.setattr(cd, "download", lambda name: csv_graph)
+        stale = tmp_path / "store" / "graph"
+        stale.mkdir(parents=True)
+        (stale / "labels.json").write_text("[]")
+
+        arrays = task1.load_graph_arrays("graph", tmp_path / "store")
+
+        assert arrays.labels
+        assert str(arrays.src.filename).startswith(
+            str(tmp_path / "store" / f"v{task1._GRAPH_STORE_FORMAT_VERSION}")
+        )
+
+
+class TestLabeledGraph:
+    def test_matrices_match_edges(self):
+        graph = cd.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+        labeled = task1.LabeledGraph.from_networkx(graph)
+
+        assert labeled.number_of_nodes == graph.number_of_nodes()
+        assert sorted(labeled.labels) == ["a", "b"]
+        assert sorted(labeled.edges()) == sorted(graph.edges(data="label"))
+        for u, v, label in graph.edges(data="label"):
+            matrix = labeled.matrices[label]
+            assert matrix[labeled.node_to_index[u], labeled.node_to_index[v]]
+
+    def test_parallel_edges_are_merged(self):
+        labeled = task1.LabeledGraph.from_edges([0, 0, 1], [1, 1, 0], ["a", "a", "b"])
+
+        assert labeled.matrices["a"].nnz == 1
+        assert labeled.matrices["a"].dtype == bool
+        assert labeled.number_of_edges == 2
+
+    @pytest.mark.parametrize(
+        "edges",
+        [
+            [((0, 0), (0, 1), "a"), ((0, 1), (1, 1), "b")],
+            [("x", 1, "a"), (1, 2.5, "b"), (2.5, "x", "a")],
+        ],
+    )
+    def test_nodes_are_not_coerced(self, edges):
+        graph = nx.MultiDiGraph()
+        graph.add_node((7, 7))
+        for u, v, label in edges:
+            graph.add_edge(u, v, label=label)
+
+        labeled = task1.LabeledGraph.from_networkx(graph)
+        from_edges = task1.LabeledGraph.from_edges(*zip(*edges))
+
+        assert labeled.nodes == list(graph.nodes)
+        assert sorted(labeled.edges(), key=repr) == sorted(edges, key=repr)
+        assert sorted(from_edges.edges(), key=repr) == sorted(edges, key=repr)
+        source, target = edges[0][0], edges[1][1]
+        assert tensor_based_rpq("a b", graph, {source}, {target}) == {(source, target)}
+        assert ms_bfs_based_rpq("a b", graph, {source}, {target}) == {(source, target)}
+
+    def test_transposed_matrices_are_cached(self):
+        labeled = task1.LabeledGraph.from_edges([0, 0, 1], [1, 2, 2], ["a", "b", "a"])
+
+        transposed = labeled.transposed_matrices
+
+        assert labeled.transposed_matrices is transposed
+        for label, matrix in labeled.matrices.items():
+            assert (transposed[label] != matrix.T).nnz == 0
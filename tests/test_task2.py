@@ -1,4 +1,6 @@
-from project.task2 import regex_to_dfa
+import cfpq_data as cd
+from project.task2 import graph_to_automaton, graph_to_nfa, regex_to_dfa
+from project.task3 import AdjacencyMatrixFA
 
 
 def test_regex_to_dfa():
@@ -14,3 +16,21 @@ def test_regex_to_dfa():
     assert not dfa.accepts("aa")
     assert not dfa.accepts("d")
     assert not dfa.accepts("ab")
+
+
+def test_graph_automaton_matches_nfa():
+    graph = cd.labeled_two_cycles_graph(3, 2, labels=("a", "b"))
+    automaton = graph_to_automaton(graph, {0}, {2, 4})
+    nfa = graph_to_nfa(graph, {0}, {2, 4})
+
+    assert len(automaton.states) == len(nfa.states)
+    assert {automaton.state_to_node(s) for s in automaton.start_states} == {0}
+    assert {automaton.state_to_node(s) for s in automaton.final_states} == {2, 4}
+    assert sorted(automaton.symbols) == ["a", "b"]
+    assert sum(automaton.transitions(s).nnz for s in automaton.symbols) == len(
+        list(nfa)
+    )
+
+    amf = AdjacencyMatrixFA(automaton)
+    for word in ["aa", "aaaa", "b", "bb", ""]:
+        assert amf.accepts(list(word)) == nfa.accepts(list(word))
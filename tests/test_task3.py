@@ -1,5 +1,21 @@
-from project.task3 import AdjacencyMatrixFA
-from pyformlang.finite_automaton import NondeterministicFiniteAutomaton, Symbol
+import networkx as nx
+import pytest
+import scipy.sparse as sp
+from project.task1 import LabeledGraph
+from project.task3 import (
+    AdjacencyMatrixFA,
+    LazyIntersectionFA,
+    RegexCache,
+    expand_front,
+    tensor_based_rpq,
+    transitive_closure,
+)
+from project.task2 import graph_to_automaton, regex_to_dfa
+from pyformlang.finite_automaton import (
+    NondeterministicFiniteAutomaton,
+    State,
+    Symbol,
+)
 
 fa_1 = NondeterministicFiniteAutomaton()
 fa_1.add_transitions([(0, "a", 1), (0, "b", 2), (1, "c", 2), (1, "a", 0)])
@@ -22,6 +38,26 @@ def test_accept():
     assert amf_1.accepts(__str_to_symbols("b"))
 
 
+def test_accepts_many():
+    words = ["aac", "aab", "aaab", "aaac", "c", "b", "", "ad", "aaaaaaab"]
+
+    assert amf_1.accepts_many(__str_to_symbols(word) for word in words) == [
+        amf_1.accepts(__str_to_symbols(word)) for word in words
+    ]
+    assert amf_1.accepts_many([]) == []
+
+
+def test_accepts_nondeterministic():
+    fa = NondeterministicFiniteAutomaton()
+    fa.add_transitions([(0, "a", 0), (0, "a", 1), (1, "a", 2)])
+    fa.add_start_state(0)
+    fa.add_final_state(2)
+    amf = AdjacencyMatrixFA(fa)
+
+    assert amf.accepts(__str_to_symbols("a" * 200))
+    assert not amf.accepts(__str_to_symbols("a"))
+
+
 def test_not_empty_fa():
     fa = NondeterministicFiniteAutomaton()
     fa.add_transitions([(0, "a", 1), (0, "b", 2), (1, "c", 2), (1, "a", 0)])
@@ -32,6 +68,27 @@ def test_not_empty_fa():
     assert not amf.is_empty()
 
 
+def test_shortest_accepting_path_length():
+    assert amf_1.shortest_accepting_path_length() == 1
+
+    fa = NondeterministicFiniteAutomaton()
+    fa.add_transitions([(0, "a", 1), (1, "a", 2), (2, "a", 3)])
+    fa.add_start_state(0)
+    fa.add_final_state(3)
+    assert AdjacencyMatrixFA(fa).shortest_accepting_path_length() == 3
+
+    fa.add_final_state(0)
+    assert AdjacencyMatrixFA(fa).shortest_accepting_path_length() == 0
+
+
+def test_epsilon_only_fa_is_not_empty():
+    fa = NondeterministicFiniteAutomaton()
+    fa.add_start_state(0)
+    fa.add_final_state(0)
+
+    assert not AdjacencyMatrixFA(fa).is_empty()
+
+
 def test_empty_fa():
     fa = NondeterministicFiniteAutomaton()
     fa.add_transitions([(0, "a", 1), (0, "b", 2), (1, "c", 2), (1, "a", 0)])
@@ -40,3 +97,144 @@ def test_empty_fa():
 
     amf = AdjacencyMatrixFA(fa)
     assert amf.is_empty()
+
+
+def test_rpq_on_labeled_graph():
+    graph = LabeledGraph.from_edges([0, 1, 2], [1, 2, 0], ["a", "b", "a"])
+    nodes = {0, 1, 2}
+
+    assert tensor_based_rpq("a b", graph, nodes, nodes) == {(0, 2)}
+    assert tensor_based_rpq("(a b a)*", graph, {0}, nodes) == {(0, 0)}
+    assert tensor_based_rpq("b a*", graph, nodes, {0, 1}) == {(1, 0), (1, 1)}
+
+
+@pytest.mark.parametrize("matrix_type", [sp.lil_matrix, sp.csc_matrix])
+def test_graph_matrices_stay_csr(matrix_type):
+    graph = LabeledGraph.from_edges([0, 1, 2], [1, 2, 0], ["a", "b", "a"])
+
+    amf = AdjacencyMatrixFA(graph_to_automaton(graph, {0}, {2}), matrix_type)
+
+    for label, matrix in graph.matrices.items():
+        assert amf.adj_matrices[Symbol(label)] is matrix
+
+
+def test_lazy_intersection_matches_eager():
+    graph = AdjacencyMatrixFA.from_edges(
+        [0, 1, 2, 3, 4], [1, 2, 0, 4, 3], ["a", "b", "a", "a", "b"], {0}, {0, 1, 2}
+    )
+    regex = AdjacencyMatrixFA(regex_to_dfa("(a b a)* a?"))
+
+    lazy = LazyIntersectionFA(graph, regex)
+    eager = AdjacencyMatrixFA.from_intersect(graph, regex)
+
+    assert lazy.states_number < eager.states_number
+    assert set(lazy.left_states.tolist()) <= {0, 1, 2}
+    for word in ["", "a", "ab", "aba", "abaa", "ba", "abab"]:
+        assert lazy.accepts(__str_to_symbols(word)) == eager.accepts(
+            __str_to_symbols(word)
+        )
+
+
+def test_lazy_intersection_of_long_cycle():
+    # one product state per BFS level, every level reaches the next one
+    n = 5000
+    graph = AdjacencyMatrixFA.from_edges(
+        range(n), [(i + 1) % n for i in range(n)], ["a"] * n, {0}, {0}, sp.csr_matrix
+    )
+    regex = AdjacencyMatrixFA(regex_to_dfa("a*"), sp.csr_matrix)
+
+    lazy = LazyIntersectionFA(graph, regex, sp.csr_matrix)
+
+    assert lazy.states_number == n
+    assert sorted(lazy.left_states.tolist()) == list(range(n))
+    assert lazy.right_states.tolist() == [0] * n
+    assert lazy.start_states == lazy.final_states == {0}
+    assert lazy.adj_matrices[Symbol("a")].nnz == n
+
+
+def test_intersection_state_decoding():
+    regex = AdjacencyMatrixFA(regex_to_dfa("a*"))
+    product = AdjacencyMatrixFA.from_intersect(amf_1, regex)
+
+    left, right = product.product_states(range(product.states_number))
+    for state, (i, j) in enumerate(zip(left, right)):
+        assert product.num_to_state[state] == State(
+            (amf_1.num_to_state[i], regex.num_to_state[j])
+        )
+        assert product.states_to_num[product.num_to_state[state]] == state
+    with pytest.raises(ValueError):
+        amf_1.product_states([0])
+
+
+def test_bulk_construction_matches_nfa():
+    amf = AdjacencyMatrixFA.from_edges(
+        [0, 0, 1, 1], [1, 2, 2, 0], ["a", "b", "c", "a"], {0}, {2}, sp.csr_matrix
+    )
+
+    assert amf.adj_matrices.keys() == amf_1.adj_matrices.keys()
+    for symbol, matrix in amf.adj_matrices.items():
+        assert isinstance(matrix, sp.csr_matrix)
+        assert matrix.nnz == amf_1.adj_matrices[symbol].nnz
+    for word in ["aac", "aab", "aaab", "aaac", "c", "b"]:
+        assert amf.accepts(__str_to_symbols(word)) == amf_1.accepts(
+            __str_to_symbols(word)
+        )
+
+
+def test_from_transitions():
+    amf = AdjacencyMatrixFA.from_transitions(
+        3, {Symbol("a"): ([0, 1], [1, 2])}, start_states=[0], final_states=[2]
+    )
+
+    assert amf.accepts(__str_to_symbols("aa"))
+    assert not amf.accepts(__str_to_symbols("a"))
+
+
+def test_regex_cache():
+    cache = RegexCache(maxsize=2)
+
+    dfa = cache.dfa("a b*")
+    assert cache.dfa("  a   b* ") is dfa
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    adjacency = cache.adjacency("a b*", sp.csr_matrix)
+    assert cache.adjacency("a b*", sp.csr_matrix) is adjacency
+    assert cache.adjacency("a b*", sp.lil_matrix) is not adjacency
+    assert (cache.hits, cache.misses) == (2, 3)
+
+    cache.dfa("c")
+    cache.dfa("d")
+    assert len(cache) == 2
+    assert cache.dfa("a b*") is not dfa
+
+
+@pytest.mark.parametrize("strategy", ["squaring", "scc", "bfs"])
+def test_transitive_closure(strategy):
+    graph = nx.gnp_random_graph(60, 0.03, seed=7, directed=True)
+    matrix = nx.to_scipy_sparse_array(graph, nodelist=range(60), format="csr")
+
+    closure = transitive_closure(matrix, strategy)
+
+    expected = nx.transitive_closure(graph, reflexive=True)
+    assert set(zip(*closure.nonzero())) == set(expected.edges)
+
+
+@pytest.mark.parametrize("direction", ["push", "pull", "auto"])
+def test_expand_front(direction):
+    graph = nx.gnp_random_graph(40, 0.3, seed=7, directed=True)
+    matrix = nx.to_scipy_sparse_array(graph, nodelist=range(40), format="csr") > 0
+    matrix, transposed = sp.csr_matrix(matrix), sp.csr_matrix(matrix.T)
+    visited = sp.identity(40, dtype=bool, format="csr")
+    front = visited
+
+    while front.nnz:
+        expected = (front @ matrix) > visited
+        front = expand_front(front, visited, matrix, transposed, direction)
+        assert (front != expected).nnz == 0
+        visited = visited + front
+    assert visited.nnz == 40 * 40
+
+
+def test_unknown_closure_strategy():
+    with pytest.raises(ValueError):
+        transitive_closure(sp.identity(2, format="csr"), "power")
@@ -0,0 +1,232 @@
+import random
+import cfpq_data as cd
+import networkx as nx
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from project.bitmatrix import BitMatrix
+from project.task1 import LabeledGraph
+from project.task2 import graph_to_automaton
+from project.task3 import AdjacencyMatrixFA, regex_cache, tensor_based_rpq
+from project.task4 import (
+    IncrementalRpq,
+    MsBfsRpq,
+    batch_size_for_budget,
+    ms_bfs_based_rpq,
+    rpq_reachable,
+)
+
+graph = LabeledGraph.from_networkx(cd.labeled_two_cycles_graph(4, 3, labels=("a", "b")))
+regexes = ["a*", "a b", "(a|b)* b", "b* a a"]
+
+
+@pytest.mark.parametrize(
+    "rpq",
+    [
+        tensor_based_rpq,
+        ms_bfs_based_rpq,
+        lambda *args, **kwargs: ms_bfs_based_rpq(*args, **kwargs, batch_size=2),
+    ],
+)
+@pytest.mark.parametrize("regex", regexes)
+def test_result_formats(rpq, regex):
+    # node names are not positions in any node order the caller knows
+    named = nx.relabel_nodes(
+        cd.labeled_two_cycles_graph(4, 3, labels=("a", "b")),
+        {node: f"v{7 - node}" for node in range(8)},
+    )
+    start, final = {"v7", "v6", "v2"}, {"v7", "v5", "v4", "v1"}
+
+    expected = rpq(regex, named, start, final)
+    nodes, sources, targets = rpq(regex, named, start, final, result_format="arrays")
+    matrix_nodes, matrix = rpq(regex, named, start, final, result_format="matrix")
+
+    assert sources.dtype == targets.dtype == np.int64
+    assert len(sources) == len(expected)
+    assert {(nodes[u], nodes[v]) for u, v in zip(sources, targets)} == expected
+    assert {
+        (matrix_nodes[u], matrix_nodes[v]) for u, v in zip(*matrix.nonzero())
+    } == expected
+
+
+@pytest.mark.parametrize("rpq", [tensor_based_rpq, ms_bfs_based_rpq])
+def test_unknown_nodes_are_skipped(rpq):
+    expected = rpq("a b", graph, {0, 3}, {1, 2})
+
+    assert rpq("a b", graph, {999, 0, 3}, {1, 2, -1}) == expected
+    assert rpq("a b", graph, {999}, {1, 2}) == set()
+    assert not rpq_reachable("a b", graph, 999, 0)
+    assert rpq_reachable("a*", graph, 0, 999, return_path=True) is None
+
+
+def test_unknown_result_format():
+    with pytest.raises(ValueError):
+        ms_bfs_based_rpq("a", graph, {0}, {1}, result_format="list")
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"batch_size": 2},
+        {"batch_size": 100},
+        {"memory_budget": 1},
+        {"workers": 2},
+        {"batch_size": 3, "workers": 2},
+    ],
+)
+def test_batched_ms_bfs(options):
+    start, final = set(graph.nodes), {0, 2, 3, 6}
+
+    expected = ms_bfs_based_rpq("(a|b)* b", graph, start, final)
+
+    assert ms_bfs_based_rpq("(a|b)* b", graph, start, final, **options) == expected
+
+
+def test_batch_size_for_budget():
+    adj_dfa = regex_cache.adjacency("a b")
+    adj_nfa = AdjacencyMatrixFA(graph_to_automaton(graph, {0}, {0}))
+    per_start = adj_dfa.states_number * adj_nfa.states_number * 18
+
+    assert batch_size_for_budget(adj_dfa, adj_nfa, 10 * per_start) == 10
+    assert batch_size_for_budget(adj_dfa, adj_nfa, 0) == 1
+
+
+@pytest.mark.parametrize("regex", regexes)
+def test_rpq_reachable(regex):
+    nodes = graph.nodes
+    expected = ms_bfs_based_rpq(regex, graph, set(nodes), set(nodes))
+    dfa = regex_cache.dfa(regex)
+    edges = set(graph.edges())
+
+    for u in nodes:
+        for v in nodes:
+            path = rpq_reachable(regex, graph, u, v, return_path=True)
+            assert rpq_reachable(regex, graph, u, v) == ((u, v) in expected)
+            assert (path is not None) == ((u, v) in expected)
+            if path:
+                assert path[0][0] == u and path[-1][1] == v
+                assert all(a[1] == b[0] for a, b in zip(path, path[1:]))
+                assert set(path) <= edges
+                assert dfa.accepts([label for _, _, label in path])
+
+
+@pytest.mark.parametrize("regex", regexes)
+def test_witness_path(regex):
+    nodes = graph.nodes
+    adj_dfa = regex_cache.adjacency(regex, sp.csr_matrix)
+    adj_nfa = AdjacencyMatrixFA(graph_to_automaton(graph, set(nodes), set(nodes)))
+    rpq = MsBfsRpq(adj_dfa, adj_nfa, record_parents=True, witness_sources=[0, 5])
+    answer = rpq()
+
+    for u in [0, 5]:
+        for v in nodes:
+            path = rpq.witness_path(u, v)
+            assert (path is not None) == ((u, v) in answer)
+            if path is not None:
+                shortest = rpq_reachable(regex, graph, u, v, return_path=True)
+                assert len(path) <= len(shortest)
+                assert all(a[1] == b[0] for a, b in zip(path, path[1:]))
+                assert regex_cache.dfa(regex).accepts([e[2] for e in path])
+    with pytest.raises(ValueError):
+        MsBfsRpq(adj_dfa, adj_nfa).witness_path(0, 0)
+    # (1, v) may well be an answer, but no parents were kept for 1
+    with pytest.raises(ValueError):
+        rpq.witness_path(1, 2)
+
+
+def test_ms_bfs_witnesses():
+    nodes = set(graph.nodes)
+
+    answer, witness_path = ms_bfs_based_rpq(
+        "(a|b)* b", graph, nodes, nodes, record_parents=True, witness_sources=[1]
+    )
+
+    assert answer == ms_bfs_based_rpq("(a|b)* b", graph, nodes, nodes)
+    for u, v in answer:
+        if u == 1:
+            path = witness_path(u, v)
+            assert path[0][0] == u and path[-1][1] == v and path[-1][2] == "b"
+    with pytest.raises(ValueError):
+        witness_path(0, 0)
+    with pytest.raises(ValueError):
+        ms_bfs_based_rpq("b", graph, nodes, nodes, batch_size=2, record_parents=True)
+
+
+@pytest.mark.parametrize("regex", regexes)
+@pytest.mark.parametrize(
+    "start, final",
+    [
+        ({0, 3, 5}, {0, 2, 3, 4, 6}),
+        (set(), set()),
+        ({1}, set()),
+        ({0, 7, 999}, {0, 7}),
+    ],
+)
+def test_incremental_rpq(regex, start, final):
+    rng = random.Random(regex)
+    nodes = list(range(8))
+    edges = [(0, 1, "a"), (1, 2, "b"), (2, 0, "a"), (3, 4, "a"), (4, 3, "b")]
+    initial = LabeledGraph.from_edges(*zip(*edges))
+    incremental = IncrementalRpq(regex, initial, start, final)
+    # start nodes missing from the graph reach nothing, not even themselves
+    assert incremental.result() == ms_bfs_based_rpq(regex, initial, start, final)
+
+    seen = {node for u, v, _ in edges for node in (u, v)}
+    for _ in range(40):
+        if edges and rng.random() < 0.4:
+            edge = edges.pop(rng.randrange(len(edges)))
+            incremental.remove_edge(*edge)
+        else:
+            edge = (rng.choice(nodes), rng.choice(nodes), rng.choice("ab"))
+            edges.append(edge)
+            incremental.add_edge(*edge)
+
+        # removed edges leave their nodes behind, added ones bring theirs
+        current = nx.MultiDiGraph()
+        current.add_nodes_from(seen)
+        current.add_edges_from((u, v, {"label": label}) for u, v, label in edges)
+        seen.update(current.nodes)
+        expected = ms_bfs_based_rpq(regex, current, start, final)
+        assert incremental.result() == expected
+        assert tensor_based_rpq(regex, current, start, final) == expected
+
+    with pytest.raises(KeyError):
+        incremental.remove_edge(0, 0, "c")
+
+
+@pytest.mark.parametrize("regex", regexes)
+def test_bit_matrix_backend(regex):
+    start, final = set(graph.nodes), {0, 2, 3, 6}
+
+    expected = ms_bfs_based_rpq(regex, graph, start, final)
+
+    assert ms_bfs_based_rpq(regex, graph, start, final, BitMatrix) == expected
+    assert tensor_based_rpq(regex, graph, start, final, BitMatrix) == expected
+
+
+@pytest.mark.parametrize("direction", ["push", "pull", "auto"])
+@pytest.mark.parametrize("matrix_type", [sp.csr_matrix, BitMatrix])
+def test_bfs_directions(direction, matrix_type):
+    # dense enough for "auto" to pull on some levels
+    rng = random.Random(5)
+    dense = nx.MultiDiGraph()
+    for u, v in nx.gnp_random_graph(30, 0.5, seed=5, directed=True).edges:
+        dense.add_edge(u, v, label=rng.choice("ab"))
+    nodes = set(dense.nodes)
+
+    for regex in ["(a|b)*", "a (a|b)* b", "(a b)*"]:
+        expected = tensor_based_rpq(regex, dense, nodes, nodes)
+        assert (
+            ms_bfs_based_rpq(
+                regex, dense, nodes, nodes, matrix_type, direction=direction
+            )
+            == expected
+        )
+        assert ms_bfs_based_rpq(
+            regex, dense, nodes, {0}, batch_size=7, direction=direction
+        ) == tensor_based_rpq(regex, dense, nodes, {0})
+
+
+def test_unknown_bfs_direction():
+    with pytest.raises(ValueError):
+        ms_bfs_based_rpq("a", graph, {0}, {1}, direction="sideways")
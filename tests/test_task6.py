@@ -0,0 +1,91 @@
+import cfpq_data as cd
+import pytest
+from pyformlang.cfg import CFG, Variable
+from project.task1 import LabeledGraph
+from project import task6
+from project.task6 import (
+    WcnfCache,
+    hellings_based_cfpq,
+    intern_grammar,
+)
+from project.task7 import matrix_based_cfpq
+
+cfg = CFG.from_text("S -> a S b | a b | $")
+graph = LabeledGraph.from_networkx(cd.labeled_two_cycles_graph(4, 3, labels=("a", "b")))
+
+
+def test_intern_grammar():
+    grammar = intern_grammar(cfg)
+
+    assert grammar.variables[grammar.start] == Variable("S")
+    assert grammar.start in grammar.nullable
+    assert sorted(grammar.terminal_heads) == ["a", "b"]
+    for rule, (head, b, c) in enumerate(grammar.binary):
+        assert max(head, b, c) < grammar.variables_number
+        assert rule in grammar.dependents[b] and rule in grammar.dependents[c]
+    assert intern_grammar(grammar) is grammar
+
+
+def test_cfpq_engines_agree():
+    nodes = set(graph.nodes)
+
+    expected = hellings_based_cfpq(cfg, graph, nodes, nodes)
+
+    assert (0, 0) in expected
+    assert matrix_based_cfpq(cfg, graph) == expected
+    assert hellings_based_cfpq(cfg, graph, {1}, nodes) == {
+        (u, v) for u, v in expected if u == 1
+    }
+
+
+def test_compiled_grammar_is_reusable():
+    grammar = intern_grammar(cfg)
+
+    assert matrix_based_cfpq(grammar, graph) == matrix_based_cfpq(cfg, graph)
+    assert hellings_based_cfpq(grammar, graph, {0}, {0, 2}) == hellings_based_cfpq(
+        cfg, graph, {0}, {0, 2}
+    )
+
+
+def test_wcnf_cache_persists_to_disk(tmp_path, monkeypatch):
+    expected = WcnfCache(store_dir=tmp_path).weak_normal_form(cfg)
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("grammar was normalized again")
+
+    monkeypatch.setattr(CFG, "to_normal_form", fail)
+    cache = WcnfCache(store_dir=tmp_path)
+    same_cfg = CFG.from_text("S -> $ | a b | a S b")
+    wcnf = cache.weak_normal_form(same_cfg)
+
+    assert cache.hits == 1 and cache.misses == 0
+    assert set(wcnf.productions) == set(expected.productions)
+    assert cache.interned(same_cfg) is cache.interned(same_cfg)
+
+
+@pytest.fixture
+def wcnf_cache_dir(tmp_path, monkeypatch):
+    # turns the disk cache on, inside the test's own directory
+    cache_dir = tmp_path / "wcnf"
+    monkeypatch.setattr(task6, "WCNF_CACHE_DIR", cache_dir)
+    return cache_dir
+
+
+def test_wcnf_cache_dir(wcnf_cache_dir, monkeypatch):
+    WcnfCache().weak_normal_form(cfg)
+    assert len(list(wcnf_cache_dir.glob("*.json"))) == 1
+
+    monkeypatch.setattr(task6, "WCNF_CACHE_DIR", None)
+    cache = WcnfCache()
+    cache.weak_normal_form(CFG.from_text("S -> a"))
+    assert cache.store_dir is None
+    assert len(list(wcnf_cache_dir.glob("*.json"))) == 1
+
+
+def test_wcnf_cache_key_includes_library_version(monkeypatch):
+    key = WcnfCache.key(cfg)
+
+    monkeypatch.setattr(task6, "_PYFORMLANG_VERSION", "0.0.0")
+
+    assert WcnfCache.key(cfg) != key